@@ -0,0 +1,385 @@
+import argparse
+from datetime import datetime
+from itertools import islice
+import json
+from os import makedirs
+from os.path import abspath, dirname, join
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import common
+from fastq2tsv import read_fastq
+import plots
+import strat_prepare
+import strat_process
+import summarize
+
+
+SCRIPT_DIR = dirname(abspath(__file__))
+
+ENTRY_POINTS = ['common', 'fastq2tsv', 'strat_prepare', 'strat_process', 'plots', 'summarize', 'strat_run', 'strat_pipeline']
+
+HEAVY_MODULES = ['matplotlib', 'seaborn', 'PIL', 'string2string']
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+QUALITIES = np.frombuffer(b'!#%&+5?I', dtype=np.uint8)
+
+EXPANSIONS = [5, 13, 20, 80, 200, 500]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='STRAT Benchmark - time STRAT stages against their baselines')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    prepare = subparsers.add_parser('prepare', help='Fuzzy flank matching of STRAT Prepare against a regex fuzzy match baseline')
+    prepare.add_argument('--config', type=str, required=True, help='Path to STRAT config file (ex. "./config.yaml")')
+    prepare.add_argument('--fastq_path', type=str, required=True, help='Path to input FASTQ(.GZ) file (ex. "/data/fastqs/reads.fastq")')
+    prepare.add_argument('--reads', type=int, default=2000, help='Number of reads to benchmark on (ex. "2000")')
+
+    align = subparsers.add_parser('align', help='Banded fragment alignment of STRAT Process against a string2string Needleman-Wunsch baseline')
+    align.add_argument('--config', type=str, required=True, help='Path to STRAT config file with motif (ex. "./config.yaml")')
+    align.add_argument('--input_path', type=str, required=True, help='Path to on-target inserts file (ex. "/data/sample/merged.ontarget.tsv")')
+    align.add_argument('--fragments', type=int, default=1000, help='Number of unique fragments between motifs to benchmark on (ex. "1000")')
+
+    startup = subparsers.add_parser('startup', help='Import time of every STRAT entry point in a fresh interpreter')
+    startup.add_argument('--modules', type=str, nargs='+', default=ENTRY_POINTS, help='Modules to import (ex. "strat_process plots")')
+    startup.add_argument('--repeats', type=int, default=5, help='Number of imports per module, the fastest is reported (ex. "5")')
+
+    generate = subparsers.add_parser('generate', help='Synthetic sample directory with merged FASTQ, on-target table and lambda alignment summary')
+    add_generator_arguments(generate)
+    generate.add_argument('--output_path', type=str, required=True, help='Path to directory to store the synthetic sample (ex. "/data/synthetic/")')
+
+    suite = subparsers.add_parser('suite', help='Time every STRAT stage on a synthetic sample and write the timings as JSON')
+    add_generator_arguments(suite)
+    suite.add_argument('--output_json', type=str, required=True, help='Path to JSON file with the timings (ex. "./benchmark.json")')
+    suite.add_argument('--work_path', type=str, default=None, help='Path to directory to keep the synthetic sample and stage outputs, a temporary directory by default (ex. "/data/synthetic/")')
+    suite.add_argument('--threshold', type=int, default=100, help='Minimum number of inserts of each size to generate consensus (ex. "100")')
+    suite.add_argument('--repeats', type=int, default=3, help='Number of runs per stage, the fastest is reported (ex. "3")')
+
+    return parser
+
+
+def add_generator_arguments(parser):
+    parser.add_argument('--config', type=str, required=True, help='Path to STRAT config file with prefix, suffix and motif (ex. "./config.yaml")')
+    parser.add_argument('--reads', type=int, default=10000, help='Number of reads (ex. "10000")')
+    parser.add_argument('--expansions', type=int, nargs='+', default=EXPANSIONS, help='Repeat counts drawn uniformly for on-target reads (ex. "5 13 80 500")')
+    parser.add_argument('--interruption_rate', type=float, default=0.02, help='Fraction of repeat units with one base substituted (ex. "0.02")')
+    parser.add_argument('--error_rate', type=float, default=0.03, help='Sequencing error rate per base, split evenly between substitutions, insertions and deletions (ex. "0.03")')
+    parser.add_argument('--offtarget_rate', type=float, default=0.1, help='Fraction of random reads without flanks (ex. "0.1")')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the read generator (ex. "42")')
+
+
+def sequencing_errors(codes, error_rate, rng):
+    # Substitutions, deletions and insertions after a base, in equal parts
+    events = rng.random(len(codes))
+    codes = codes.copy()
+    substituted = events < error_rate / 3
+    codes[substituted] = BASES[rng.integers(0, 4, substituted.sum())]
+    deleted = (events >= error_rate / 3) & (events < 2 * error_rate / 3)
+    inserted = (events >= 2 * error_rate / 3) & (events < error_rate)
+    repeats = 1 - deleted + inserted
+    codes = np.repeat(codes, repeats)
+    ends = np.cumsum(repeats) - 1
+    codes[ends[inserted]] = BASES[rng.integers(0, 4, inserted.sum())]
+    return codes
+
+
+def repeat_codes(motif, count, interruption_rate, rng):
+    # Repeat units with one base of interrupted units substituted
+    units = np.tile(np.frombuffer(motif.encode('ascii'), dtype=np.uint8), (count, 1))
+    interrupted = np.flatnonzero(rng.random(count) < interruption_rate)
+    positions = rng.integers(0, len(motif), len(interrupted))
+    bases = np.searchsorted(BASES, units[interrupted, positions])
+    units[interrupted, positions] = BASES[(bases + rng.integers(1, 4, len(interrupted))) % 4]
+    return units.ravel()
+
+
+def synthetic_reads(prefix, suffix, motif, reads, expansions, interruption_rate, error_rate, offtarget_rate, seed):
+    # Reads with random context around noisy flanks and repeat, half of them
+    # reverse complemented, and rows of their on-target inserts in
+    # COLUMNS_PREPARED order as STRAT Prepare would find them
+    rng = np.random.default_rng(seed)
+    prefix = np.frombuffer(prefix.encode('ascii'), dtype=np.uint8)
+    suffix = np.frombuffer(suffix.encode('ascii'), dtype=np.uint8)
+    for i in range(reads):
+        id = f'@read{i}'
+        if rng.random() < offtarget_rate:
+            seq = BASES[rng.integers(0, 4, rng.integers(100, 1500))].tobytes().decode('ascii')
+            qual = QUALITIES[rng.integers(0, len(QUALITIES), len(seq))].tobytes().decode('ascii')
+            yield id, seq, qual, None
+            continue
+
+        parts = [
+            BASES[rng.integers(0, 4, rng.integers(20, 200))],
+            sequencing_errors(prefix, error_rate, rng),
+            sequencing_errors(repeat_codes(motif, int(rng.choice(expansions)), interruption_rate, rng), error_rate, rng),
+            sequencing_errors(suffix, error_rate, rng),
+            BASES[rng.integers(0, 4, rng.integers(20, 200))],
+        ]
+        parts = [part.tobytes().decode('ascii') for part in parts]
+        direction = 'fwd'
+        if rng.random() < 0.5:
+            direction = 'rev'
+            parts = [common.rev_comp(part) for part in reversed(parts)]
+        seq = ''.join(parts)
+        qual = QUALITIES[rng.integers(0, len(QUALITIES), len(seq))].tobytes().decode('ascii')
+        starts = np.cumsum([0] + [len(part) for part in parts])
+        flanks = [seq[starts[j]:starts[j + 1]] for j in range(1, 4)]
+        quals = [qual[starts[j]:starts[j + 1]] for j in range(1, 4)]
+        yield id, seq, qual, [direction, id] + flanks + quals
+
+
+def generate_sample(config_path, output_path, reads, expansions, interruption_rate, error_rate, offtarget_rate, seed):
+    # merged.fastq, merged.ontarget.tsv and a lambda alignment summary without
+    # lambda reads, laid out as a STRAT Pipeline sample directory
+    config = strat_prepare.load_config(config_path)
+    makedirs(join(output_path, 'lambda_alignment'), exist_ok=True)
+    ontarget = 0
+    with open(join(output_path, 'merged.fastq'), 'w') as f, open(join(output_path, 'merged.ontarget.tsv'), 'w') as o:
+        for id, seq, qual, row in synthetic_reads(config['prefix'], config['suffix'], config['motif'], reads, expansions, interruption_rate, error_rate, offtarget_rate, seed):
+            f.write(f'{id} synthetic\n{seq}\n+\n{qual}\n')
+            if row is not None:
+                o.write('\t'.join(row) + '\n')
+                ontarget += 1
+    with open(join(output_path, 'lambda_alignment', 'lambda_alignment_summary.tsv'), 'w') as f:
+        f.write(f'Aligned\t0\nUnaligned\t{reads}\n')
+    print(f'{datetime.now()} - STRAT Benchmark - Written {reads} reads, {ontarget} on-target, to {output_path}')
+    return ontarget
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def regex_prepare_reads(reads, prefix, suffix, tolerance):
+    # Baseline - best fuzzy match of each flank with the regex module
+    import regex
+
+    patterns = {
+        'fwd': (prefix, suffix),
+        'rev': (common.rev_comp(suffix), common.rev_comp(prefix)),
+    }
+    patterns = {
+        direction: (regex.compile(f'(?:{p}){tolerance}', regex.BESTMATCH), regex.compile(f'(?:{s}){tolerance}', regex.BESTMATCH))
+        for direction, (p, s) in patterns.items()
+    }
+    rows = []
+    for id, seq, qual in reads:
+        candidates = []
+        for direction, (pattern_prefix, pattern_suffix) in patterns.items():
+            match_prefix = pattern_prefix.search(seq)
+            if not match_prefix:
+                continue
+            match_suffix = pattern_suffix.search(seq, match_prefix.end())
+            if not match_suffix:
+                continue
+            dist = sum(match_prefix.fuzzy_counts) + sum(match_suffix.fuzzy_counts)
+            candidates.append((dist, direction, match_prefix.span(), match_suffix.span()))
+        if candidates:
+            _, direction, (ps, pe), (ss, se) = min(candidates, key=lambda c: c[0])
+            rows.append([direction, id, seq[ps:pe], seq[pe:ss], seq[ss:se], qual[ps:pe], qual[pe:ss], qual[ss:se]])
+    return rows
+
+
+def bench_prepare(config_path, fastq_path, n):
+    config = strat_prepare.load_config(config_path)
+    prefix = config['prefix']
+    suffix = config['suffix']
+    tolerance = config['tolerance']
+    strat_prepare.check_flanks(prefix, suffix)
+    k = strat_prepare.parse_tolerance(tolerance)
+    reads = list(islice(read_fastq(fastq_path), n))
+
+    rows, elapsed = timed(strat_prepare.prepare_reads, reads, prefix, suffix, k)
+    rows_baseline, elapsed_baseline = timed(regex_prepare_reads, reads, prefix, suffix, tolerance)
+
+    inserts = {row[1]: (row[0], row[3]) for row in rows}
+    inserts_baseline = {row[1]: (row[0], row[3]) for row in rows_baseline}
+    same = sum(inserts.get(id) == ins for id, ins in inserts_baseline.items())
+
+    print(f'{datetime.now()} - STRAT Benchmark - {len(reads)} reads, single core')
+    print(f'myers: {elapsed:.3f} s, {len(reads) / elapsed:.0f} reads/s, {len(rows)} on-target')
+    print(f'regex: {elapsed_baseline:.3f} s, {len(reads) / elapsed_baseline:.0f} reads/s, {len(rows_baseline)} on-target')
+    print(f'speedup: {elapsed_baseline / elapsed:.1f}x, identical inserts: {same} of {len(rows_baseline)}')
+
+
+def string2string_fit_fragment(t, motif, nw):
+    # Baseline - full Needleman-Wunsch matrix of string2string, fragment
+    # projected on the ideal repeat as align_fragment does
+    source = int(np.round(len(t) / len(motif))) * motif
+    aligned_source, aligned_target = nw.get_alignment(source, t, return_score_matrix=False)
+    return ''.join('I' if b == '-' else b for a, b in zip(aligned_source.split(' | '), aligned_target.split(' | ')) if a != '-')
+
+
+def fragments_to_fit(input_path, motif, n):
+    # Unique fragments between motifs of oriented extended inserts that are
+    # not a multiple of the motif, the ones fit_target pads or aligns
+    df = strat_process.load(input_path, strat_process.COLUMNS)
+    df['ins_ext'] = strat_process.extend_ins_batch(df, strat_process.set_motifs(motif, motif))
+    df = common.orient(df, ['ins_ext'])
+    fragments = {}
+    for seq in df['ins_ext'].unique():
+        for t in seq.split(motif):
+            if len(t) % len(motif):
+                fragments[t] = None
+    return list(fragments)[:n]
+
+
+def bench_align(config_path, input_path, n):
+    from string2string.alignment import NeedlemanWunsch
+
+    motif = strat_prepare.load_config(config_path)['motif']
+    fragments = fragments_to_fit(input_path, motif, n)
+    nw = NeedlemanWunsch(match_weight=common.MATCH_WEIGHT, mismatch_weight=common.MISMATCH_WEIGHT, gap_weight=common.GAP_WEIGHT)
+
+    strat_process.FRAGMENT_CACHE.clear()
+    fits, elapsed = timed(lambda: [strat_process.align_fragment(t, motif) for t in fragments])
+    _, elapsed_cached = timed(lambda: [strat_process.align_fragment(t, motif) for t in fragments])
+    fits_baseline, elapsed_baseline = timed(lambda: [string2string_fit_fragment(t, motif, nw) for t in fragments])
+    same = sum(fit == fit_baseline for fit, fit_baseline in zip(fits, fits_baseline))
+
+    print(f'{datetime.now()} - STRAT Benchmark - {len(fragments)} unique fragments, mean length {np.mean([len(t) for t in fragments]):.1f}, single core')
+    print(f'banded: {elapsed:.3f} s, {len(fragments) / elapsed:.0f} fragments/s, memoized {elapsed_cached:.4f} s')
+    print(f'string2string: {elapsed_baseline:.3f} s, {len(fragments) / elapsed_baseline:.0f} fragments/s')
+    print(f'speedup: {elapsed_baseline / elapsed:.1f}x, identical fits: {same} of {len(fragments)}')
+
+
+def import_time(code, repeats):
+    # Fastest wall time of a fresh interpreter running code, and its output
+    elapsed = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True).stdout
+        elapsed.append(time.perf_counter() - start)
+    return min(elapsed), output.strip()
+
+
+def bench_startup(modules, repeats):
+    interpreter, _ = import_time('pass', repeats)
+    print(f'{datetime.now()} - STRAT Benchmark - Import time, fastest of {repeats}, interpreter startup {interpreter:.3f} s')
+    for module in modules:
+        code = f'import sys, {module}; print(" ".join(m for m in {HEAVY_MODULES} if m in sys.modules))'
+        elapsed, heavy = import_time(code, repeats)
+        print(f'{module}: {elapsed - interpreter:.3f} s, heavy modules loaded: {heavy or "none"}')
+
+
+def calibration_work():
+    # Fixed pure Python and NumPy workload, stage times are also reported
+    # relative to it to compare runs across machines
+    sum(i * i for i in range(10 ** 6))
+    np.sort(np.random.default_rng(0).random(10 ** 6))
+
+
+def time_stage(stages, name, rows, repeats, func, setup=None):
+    # Fastest of repeats runs of func, recorded in stages, with its last result
+    elapsed = []
+    for _ in range(repeats):
+        if setup:
+            setup()
+        result, seconds = timed(func)
+        elapsed.append(seconds)
+    seconds = min(elapsed)
+    stages[name] = {'seconds': seconds, 'rows': rows, 'rows_per_s': rows / seconds if seconds else None}
+    print(f'{datetime.now()} - STRAT Benchmark - {name}: {seconds:.3f} s, {rows} rows')
+    return result
+
+
+def run_suite(sample_path, motif, threshold, repeats, reads):
+    # Stages in STRAT order, each fed with the previous stage's output
+    stages = {}
+    fastq_path = join(sample_path, 'merged.fastq')
+    reads = time_stage(stages, 'read_fastq', reads, repeats, lambda: list(read_fastq(fastq_path)))
+
+    df = strat_process.load(join(sample_path, 'merged.ontarget.tsv'), strat_process.COLUMNS)
+    motifs = strat_process.set_motifs(motif, motif)
+    df['ins_ext'] = time_stage(stages, 'extend_ins', len(df), repeats, lambda: strat_process.extend_ins_batch(df, motifs))
+    df = common.orient(df, ['ins', 'ins_ext'])
+    df = strat_process.lengths(df, strat_process.COLUMNS_SEQ + strat_process.COLUMNS_SEQ_EXT, strat_process.COLUMNS_LEN + strat_process.COLUMNS_LEN_EXT)
+
+    # Fits are cached across calls, every run starts from an empty cache
+    df['ins_aln'], df['ins_ext_aln'] = time_stage(stages, 'align', 2 * len(df), repeats, lambda: (
+        strat_process.align(df, 'ins', 'len_ins', motif),
+        strat_process.align(df, 'ins_ext', 'len_ins_ext', motif),
+    ), strat_process.FIT_CACHE.clear)
+    df = strat_process.lengths(df, strat_process.COLUMNS_SEQ_ALN, strat_process.COLUMNS_LEN_ALN)
+    df['ins_ext_repeats'] = time_stage(stages, 'encode_repeats', len(df), repeats, lambda: strat_process.encode_repeats(df, 'ins_ext', motif), strat_process.REPEAT_CACHE.clear)
+
+    def consensus():
+        for column_seq, column_len, _, _ in strat_process.CONSENSUS:
+            abundant_lengths = strat_process.get_abundant_lengths(df, column_seq, column_len, threshold)
+            strat_process.get_consensus_strings(df, abundant_lengths, column_seq, column_len, strat_process.DIRECTIONS)
+    time_stage(stages, 'get_consensus_strings', len(strat_process.CONSENSUS) * len(df), repeats, consensus)
+
+    time_stage(stages, 'prepare_for_plotting', len(df), repeats, lambda: [
+        common.prepare_for_plotting(df[df['direction'] == direction][['ins_ext_aln', 'len_ins_ext_aln']], 'ins_ext_aln', 'len_ins_ext_aln', 'cnt_ins_ext_aln', 'cov_ins_ext_aln')
+        for direction in strat_process.DIRECTIONS
+    ])
+
+    df_fastq = pd.DataFrame([(seq, id) for id, seq, _ in reads], columns=['seq', 'id'])
+    time_stage(stages, 'waterfall', len(df_fastq), repeats, lambda: plots.plot_reads(plots.sample_reads(df_fastq, df), sample_path, motif))
+    time_stage(stages, 'waterfall_processed', len(df), repeats, lambda: plots.plot_waterfalls_processed(*plots.sample_processed([df]), f'{sample_path}/'))
+
+    output_processed = join(sample_path, 'merged.ontarget.processed.tsv')
+    with common.table_writer(output_processed) as write:
+        write(df[common.COLUMNS_PROCESSED])
+    lambda_path = join(sample_path, 'lambda_alignment', 'lambda_alignment_summary.tsv')
+    time_stage(stages, 'summarize', len(df), repeats, lambda: summarize.main(lambda_path, output_processed, sample_path))
+    return stages
+
+
+def bench_suite(config_path, output_json, work_path, reads, expansions, interruption_rate, error_rate, offtarget_rate, seed, threshold, repeats):
+    config = strat_prepare.load_config(config_path)
+    with tempfile.TemporaryDirectory() as temp_path:
+        sample_path = abspath(work_path or temp_path)
+        ontarget = generate_sample(config_path, sample_path, reads, expansions, interruption_rate, error_rate, offtarget_rate, seed)
+        calibration = min(timed(calibration_work)[1] for _ in range(repeats))
+        stages = run_suite(sample_path, config['motif'], threshold, repeats, reads)
+
+    for stage in stages.values():
+        stage['relative'] = stage['seconds'] / calibration
+    result = {
+        'started': datetime.now().isoformat(),
+        'parameters': {
+            'reads': reads, 'ontarget': ontarget, 'expansions': expansions, 'interruption_rate': interruption_rate,
+            'error_rate': error_rate, 'offtarget_rate': offtarget_rate, 'seed': seed, 'threshold': threshold,
+            'repeats': repeats, 'motif': config['motif'],
+        },
+        'versions': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__},
+        'machine': {'platform': platform.platform(), 'processor': platform.processor()},
+        'calibration_seconds': calibration,
+        'stages': stages,
+    }
+    with open(output_json, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'{datetime.now()} - STRAT Benchmark - Written timings of {len(stages)} stages to {output_json}')
+
+
+def main():
+    parser = parse_arguments()
+    args = parser.parse_args()
+    if args.benchmark == 'prepare':
+        try:
+            bench_prepare(args.config, args.fastq_path, args.reads)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.benchmark == 'align':
+        bench_align(args.config, args.input_path, args.fragments)
+    elif args.benchmark == 'startup':
+        bench_startup(args.modules, args.repeats)
+    elif args.benchmark == 'generate':
+        generate_sample(args.config, args.output_path, args.reads, args.expansions, args.interruption_rate, args.error_rate, args.offtarget_rate, args.seed)
+    elif args.benchmark == 'suite':
+        bench_suite(args.config, args.output_json, args.work_path, args.reads, args.expansions, args.interruption_rate, args.error_rate, args.offtarget_rate, args.seed, args.threshold, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,19 @@
 from csv import QUOTE_NONE
 from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime
-import matplotlib.pyplot as plt
-import matplotlib.ticker as plticker
+from itertools import groupby
+from os.path import isfile
+import re
+import shutil
 import numpy as np
 import pandas as pd
-from PIL import Image, ImageDraw
-import seaborn as sns
-from string2string.alignment import NeedlemanWunsch
 
 
 DIRECTIONS = ['fwd', 'rev']
 
+DIRECTION_DTYPE = pd.CategoricalDtype(DIRECTIONS)
+
 COMPLEMENT = {
     'A': 'T',
     'C': 'G',
@@ -19,6 +21,8 @@ COMPLEMENT = {
     'T': 'A'
 }
 
+COMPLEMENT_TABLE = str.maketrans(COMPLEMENT)
+
 COLUMNS_PREPARED = [
     'direction',
     'id',
@@ -41,6 +45,7 @@ COLUMNS_PROCESSED = [
     'ins_aln',
     'ins_ext',
     'ins_ext_aln',
+    'ins_ext_repeats',
 ]
 
 COLUMNS_SEQ = [
@@ -60,12 +65,11 @@ COLUMNS_LEN = [
 MATCH_WEIGHT = 10
 MISMATCH_WEIGHT = -8
 GAP_WEIGHT = -9
-NW = NeedlemanWunsch(
-    match_weight=MATCH_WEIGHT,
-    mismatch_weight=MISMATCH_WEIGHT,
-    gap_weight=GAP_WEIGHT,
-    gap_char=''
-)
+
+# Cells scored on either side of the diagonal joining both ends of an alignment
+ALIGNMENT_BAND = 6
+
+PILEUP_BATCH = 10000
 
 COLORS = {
     'A': '#3DA853',  # green
@@ -77,22 +81,186 @@ COLORS = {
 }
 
 
-def rev_comp(seq, comps=COMPLEMENT):
-    return ''.join(comps.get(n, n) for n in reversed(seq))
+def rev_comp(seq, table=COMPLEMENT_TABLE):
+    return seq.translate(table)[::-1]
+
+
+def orient(df, columns_seq, table=COMPLEMENT_TABLE):
+    # Reverse complement all sequence columns of 'rev' reads in one pass
+    cond = df['direction'] == 'rev'
+    for column_seq in columns_seq:
+        df.loc[cond, column_seq] = df.loc[cond, column_seq].str.translate(table).str[::-1]
+    return df
+
+
+def string_dtype():
+    # Arrow-backed strings with NaN for missing values, the pandas 3 default
+    # str dtype, or Python strings without pyarrow
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return object
+    try:
+        return pd.StringDtype('pyarrow', na_value=np.nan)
+    except TypeError:
+        return pd.StringDtype('pyarrow_numpy')
+
+
+def columnar_path(path):
+    return (path[:-len('.tsv')] if path.endswith('.tsv') else path) + '.parquet'
+
+
+def find_table(path):
+    # Fall back to the columnar copy of a table written with --output_format parquet
+    if not isfile(path) and isfile(columnar_path(path)):
+        return columnar_path(path)
+    return path
+
+
+def to_columnar(df):
+    # Typed lengths and dictionary-encoded direction for columnar outputs
+    df = df.copy()
+    for column in df.columns:
+        if column.startswith('len_'):
+            df[column] = df[column].astype('Int32')
+    if 'direction' in df.columns:
+        df['direction'] = pd.Categorical(df['direction'], categories=DIRECTIONS)
+    return df
+
+
+@contextmanager
+def table_writer(output_path):
+    # Write a table in one or more parts, as TSV or as Parquet by extension
+    if output_path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writers = []
+
+        def write(df):
+            table = pa.Table.from_pandas(to_columnar(df), preserve_index=False)
+            if not writers:
+                writers.append(pq.ParquetWriter(output_path, table.schema))
+            writers[0].write_table(table.cast(writers[0].schema))
+
+        try:
+            yield write
+        finally:
+            for writer in writers:
+                writer.close()
+    else:
+        with open(output_path, 'w') as o:
+            def write(df):
+                df.to_csv(o, sep='\t', index=False, header=o.tell() == 0)
+
+            yield write
+
 
+def concat_tables(input_paths, output_path):
+    # Tables written by table_writer joined in order, TSVs keeping the header
+    # of the first one and Parquet files copied row group by row group
+    if output_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        with pq.ParquetWriter(output_path, pq.ParquetFile(input_paths[0]).schema_arrow) as writer:
+            for input_path in input_paths:
+                table = pq.ParquetFile(input_path)
+                for i in range(table.num_row_groups):
+                    writer.write_table(table.read_row_group(i))
+    else:
+        with open(output_path, 'wb') as o:
+            for i, input_path in enumerate(input_paths):
+                with open(input_path, 'rb') as f:
+                    if i > 0:
+                        f.readline()
+                    shutil.copyfileobj(f, o)
+
+
+def read_table_chunks(input_path, usecols, chunksize, dtype=None, columns=None):
+    # Chunks of a TSV with a header, or of a headerless TSV with columns
+    # given, or of its columnar copy
+    input_path = find_table(input_path)
+    if input_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(input_path).iter_batches(batch_size=chunksize, columns=usecols):
+            yield batch.to_pandas()
+    else:
+        header = None if columns else 0
+        yield from pd.read_csv(input_path, sep='\t', header=header, names=columns, usecols=usecols, dtype=dtype, keep_default_na=False, quoting=QUOTE_NONE, chunksize=chunksize)
+
+
+def load_tsv(input_path, columns=None, usecols=None):
+    input_path = find_table(input_path)
+    if input_path.endswith('.parquet'):
+        return pd.read_parquet(input_path, columns=usecols)
 
-def load_tsv(input_path, columns=None):
     if columns:
         header = None
     else:
         header = 0
-    df = pd.read_csv(input_path, sep='\t', header=header, quoting=QUOTE_NONE)
-    if columns:
-        df.columns = columns
+    df = pd.read_csv(input_path, sep='\t', header=header, names=columns, usecols=usecols, quoting=QUOTE_NONE)
 
     return df
 
 
+def banded_alignment(source, target, band=ALIGNMENT_BAND, match_weight=MATCH_WEIGHT, mismatch_weight=MISMATCH_WEIGHT, gap_weight=GAP_WEIGHT, gap_char='-'):
+    # Needleman-Wunsch global alignment with linear gaps, scoring only cells
+    # within band of the diagonal from (0, 0) to (len(source), len(target)).
+    # Rows keep only their band, ties are broken as string2string does.
+    len_source = len(source)
+    len_target = len(target)
+    low = min(0, len_target - len_source) - band
+    high = max(0, len_target - len_source) + band
+    bounds = [(max(0, i + low), min(len_target, i + high)) for i in range(len_source + 1)]
+    rows = []
+
+    def score(i, j):
+        start, end = bounds[i]
+        return rows[i][j - start] if start <= j <= end else float('-inf')
+
+    rows.append([j * gap_weight for j in range(bounds[0][0], bounds[0][1] + 1)])
+    for i in range(1, len_source + 1):
+        start, end = bounds[i]
+        previous = rows[-1]
+        previous_start, previous_end = bounds[i - 1]
+        base = source[i - 1]
+        row = []
+        left = float('-inf')
+        for j in range(start, end + 1):
+            if j == 0:
+                left = i * gap_weight
+            else:
+                diagonal = previous[j - 1 - previous_start] if j - 1 >= previous_start else float('-inf')
+                diagonal += match_weight if base == target[j - 1] else mismatch_weight
+                up = previous[j - previous_start] + gap_weight if j <= previous_end else float('-inf')
+                left = max(diagonal, left + gap_weight, up)
+            row.append(left)
+        rows.append(row)
+
+    # Trace back preferring a match or mismatch, then a gap in source, then a
+    # gap in target
+    aligned_source = []
+    aligned_target = []
+    i = len_source
+    j = len_target
+    while i > 0 or j > 0:
+        if i > 0 and j > 0 and score(i, j) == score(i - 1, j - 1) + (match_weight if source[i - 1] == target[j - 1] else mismatch_weight):
+            i -= 1
+            j -= 1
+            aligned_source.append(source[i])
+            aligned_target.append(target[j])
+        elif j > 0 and (i == 0 or score(i, j) == score(i, j - 1) + gap_weight):
+            j -= 1
+            aligned_source.append(gap_char)
+            aligned_target.append(target[j])
+        else:
+            i -= 1
+            aligned_source.append(source[i])
+            aligned_target.append(gap_char)
+    return ''.join(reversed(aligned_source)), ''.join(reversed(aligned_target))
+
+
 def lengths(df, columns_seq, columns_len):
     for s, l in zip(columns_seq, columns_len):
         df[l] = df[s].str.len()
@@ -110,25 +278,76 @@ def freqs(seq, targets):
     return res
 
 
+def unit_runs(seq, len_motif):
+    # Runs of equal units of a fragment cut into motif-length units, the last
+    # unit shorter when the fragment is not a multiple of the motif
+    units = (seq[i:i + len_motif] for i in range(0, len(seq), len_motif))
+    return [(unit, sum(1 for _ in run)) for unit, run in groupby(units)]
+
+
+def repeat_tokens(seq, motif):
+    # Run-length encoding of a repeat tract in motif units and interruptions
+    # (ex. 'CAG×85 CCG×1 CTG×3'), fragments between runs of the motif are cut
+    # into units in their own frame
+    runs = []
+    start = 0
+    for match in re.finditer(f'(?:{re.escape(motif)})+', seq):
+        runs += unit_runs(seq[start:match.start()], len(motif))
+        runs.append((motif, (match.end() - match.start()) // len(motif)))
+        start = match.end()
+    runs += unit_runs(seq[start:], len(motif))
+    return ' '.join(f'{unit}×{count}' for unit, count in runs)
+
+
+def encode(seqs, width):
+    # Sequences as rows of a uint8 matrix, zero padded to width
+    return np.frombuffer(b''.join(s.encode('ascii').ljust(width, b'\0') for s in seqs), dtype=np.uint8).reshape(len(seqs), width)
+
+
+def pileup(seqs, width, batch_size=PILEUP_BATCH):
+    # Per position counts of every byte value, from batches of sequences
+    # encoded as padded matrices
+    counts = np.zeros((width, 256), dtype=np.int64)
+    for start in range(0, len(seqs), batch_size):
+        batch = seqs[start:start + batch_size]
+        codes = encode(batch, max(len(s) for s in batch))
+        present = np.flatnonzero(np.bincount(codes.ravel(), minlength=256)[1:]) + 1
+        for code in present:
+            counts[:codes.shape[1], code] += (codes == code).sum(axis=0)
+    return counts
+
+
 def prepare_for_plotting(df, col_seq, col_len, col_cnt, col_cov):
-    results = []
-    for i in range(df[col_len].max()):
-        cond = df[col_len] >= i + 1
-        row = dict(df[cond][col_seq].str[i].value_counts())
-        
-        cond = df[col_len] == i + 1
-        row[col_cnt] = sum(cond)
-        
-        cond = df[col_len] >= i + 1
-        row[col_cov] = sum(cond)
-        
-        results.append(row)
-    
-    result_df = pd.DataFrame(results).fillna(0).astype(int)
-    return result_df
+    # Base counts, reads ending (cnt) and reads covering (cov) each position
+    df = df[df[col_len].notna()]
+    width = int(df[col_len].max())
+    if width == 0:
+        return pd.DataFrame()
+    lens = df[col_len].to_numpy(dtype=np.int64)
+    seqs = [s[:l] for s, l in zip(df[col_seq], lens)]
+
+    counts = pileup(seqs, width)
+    cnt = np.bincount(lens, minlength=width + 1)[1:width + 1]
+    cov = cnt[::-1].cumsum()[::-1]
+
+    # Bases in the order per position value counts list them - by first
+    # position seen, then by count and by first read at that position
+    codes = np.flatnonzero(counts.any(axis=0))
+    first_pos = (counts[:, codes] > 0).argmax(axis=0)
+    order = sorted(zip(first_pos, -counts[first_pos, codes], codes), key=lambda key: (
+        key[0], key[1], next(j for j, s in enumerate(seqs) if len(s) > key[0] and ord(s[key[0]]) == key[2])
+    ))
+
+    result = {chr(code): counts[:, code] for pos, _, code in order if pos == 0}
+    result[col_cnt] = cnt
+    result[col_cov] = cov
+    result.update({chr(code): counts[:, code] for pos, _, code in order if pos > 0})
+    return pd.DataFrame(result)
 
 
 def plot(df, col_seq, width, output_path):
+    from PIL import Image, ImageDraw
+
     output_image = f'{output_path}{col_seq}.png'
     col_len = 'len_' + col_seq
     col_cnt = 'cnt_' + col_seq
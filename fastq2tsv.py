@@ -1,8 +1,26 @@
 # FASTQ to TSV file conversion
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 import gzip
-from os import listdir
-from os.path import isfile, join
+import io
+from itertools import islice, repeat
+import mmap
+from os import listdir, makedirs
+from os.path import getsize, isfile, join
+import shutil
+from shutil import which
+import subprocess
+import zlib
+
+import metrics
+
+WRITE_BUFFER = 1 << 20
+WRITE_BATCH = 10000
+WRITE_BATCHES = {
+    'tsv': WRITE_BATCH,
+    'parquet': 10 * WRITE_BATCH,
+}
 
 # parse fastq path 
 
@@ -12,70 +30,227 @@ def parse_arguments():
     # Define string parameters
     parser.add_argument('--fastq_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
     parser.add_argument('--output_path', type=str, required=True, help='Path to store output files (ex. "/data/outputs/file.tsv")')
+    parser.add_argument('--workers', type=int, default=1, help='Number of FASTQ files converted in parallel (ex. "8")')
+    parser.add_argument('--output_format', type=str, default='tsv', choices=['tsv', 'parquet'], help='Format of the output file, parquet replaces a .tsv extension (ex. "parquet")')
+    parser.add_argument('--metrics', type=str, default=None, help='Path to JSON or TSV file with wall time, CPU time, peak memory and rows of every stage (ex. "/data/outputs/fastq2tsv.metrics.tsv")')
+    parser.add_argument('--profile', type=str, default=None, help='Path to cProfile stats of the whole run (ex. "/data/outputs/fastq2tsv.prof")')
     return parser
 
 
-def read_fastq(fastq_path):  # Ulazi kroz komandnu liniju kao dir
-    fastq_name = fastq_path.split('/')[-1]
-    gzipped = fastq_name.endswith('.gz')
-    openner = gzip.open if gzipped else open
+class ChunkStream(io.RawIOBase):
+    # Read-only binary stream over an iterator of byte chunks
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.leftover = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.leftover:
+            self.leftover = next(self.chunks, None)
+            if self.leftover is None:
+                self.leftover = b''
+                return 0
+        n = min(len(b), len(self.leftover))
+        b[:n] = self.leftover[:n]
+        self.leftover = self.leftover[n:]
+        return n
+
+
+def bgzf_blocks(buf):
+    # (start, end) offsets of all gzip members of a blocked gzip (BGZF) file,
+    # taken from the BSIZE extra subfield, or None if any member lacks it
+    blocks = []
+    pos = 0
+    while pos < len(buf):
+        if buf[pos:pos + 4] != b'\x1f\x8b\x08\x04':
+            return None
+        xlen = int.from_bytes(buf[pos + 10:pos + 12], 'little')
+        extra = buf[pos + 12:pos + 12 + xlen]
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = int.from_bytes(extra[i + 2:i + 4], 'little')
+            if extra[i:i + 2] == b'BC' and slen == 2:
+                bsize = int.from_bytes(extra[i + 4:i + 6], 'little') + 1
+            i += 4 + slen
+        if bsize is None:
+            return None
+        blocks.append((pos, pos + bsize))
+        pos += bsize
+    return blocks
+
+
+def decompress_blocks(buf, blocks, threads, window=256):
+    # zlib releases the GIL, so members are inflated in parallel by threads;
+    # a window of blocks is decompressed at a time and yielded in order
+    with ThreadPoolExecutor(threads) as executor:
+        for start in range(0, len(blocks), window):
+            members = (buf[s:e] for s, e in blocks[start:start + window])
+            yield from executor.map(lambda member: zlib.decompress(member, wbits=31), members)
+
 
-    reads = []
+@contextmanager
+def open_fastq(fastq_path, threads=1):
+    # Gzipped files are decompressed by an external pigz/gzip process when
+    # available, so decompression runs alongside parsing. Multi-member BGZF
+    # files are decompressed by several threads when threads > 1.
+    if not fastq_path.endswith('.gz'):
+        with open(fastq_path, 'rt') as f:
+            yield f
+        return
 
+    if threads > 1 and getsize(fastq_path) > 0:
+        with open(fastq_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            blocks = bgzf_blocks(buf)
+            if blocks is not None:
+                yield io.TextIOWrapper(io.BufferedReader(ChunkStream(decompress_blocks(buf, blocks, threads))))
+                return
+
+    tool = which('pigz') or which('gzip')
+    if tool is None:
+        with gzip.open(fastq_path, 'rt') as f:
+            yield f
+        return
+
+    proc = subprocess.Popen([tool, '-dc', fastq_path], stdout=subprocess.PIPE)
+    try:
+        yield io.TextIOWrapper(proc.stdout)
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        raise OSError(f'Error in {fastq_path} - {tool} exited with code {proc.returncode}')
+
+
+def read_fastq(fastq_path, threads=1):  # Ulazi kroz komandnu liniju kao dir
     if not isfile(fastq_path):
-        return reads
-
-    with openner(fastq_path, 'rt') as f:
-        for i, line in enumerate(f):
-            line = line.strip()
-            if i%4 == 0:
-                if line.startswith('@'):
-                    id = line.split(' ')[0]
-                else:
-                    print(f'Error in {fastq_path} line {i} - not an ID line')
-                    raise
-            elif i%4 == 1:
-                seq = line
-            elif i%4 == 2:
-                if line.startswith('+'):
-                    opt = line
-                else:
-                    print(f'Error in {fastq_path} line {i} - not a + line')
-                    raise
-            elif i%4 == 3:
-                qual = line
-                reads.append({
-                    'id': id,
-                    'seq': seq,
-                    'qual': qual,
-                })
-
-    return reads
-
-
-def write_reads(input_path, output_path):
+        return
+
+    with open_fastq(fastq_path, threads) as f:
+        for i, (header, seq, opt, qual) in enumerate(zip(f, f, f, f)):
+            if not header.startswith('@'):
+                raise ValueError(f'Error in {fastq_path} line {4*i} - not an ID line')
+            if not opt.startswith('+'):
+                raise ValueError(f'Error in {fastq_path} line {4*i+2} - not a + line')
+            yield header.strip().split(' ')[0], seq.strip(), qual.strip()
+
+
+@contextmanager
+def open_writer(output_path, output_format='tsv'):
+    # Callable writing batches of (id, seq) reads as TSV rows or Parquet row groups
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([('seq', pa.string()), ('id', pa.string())])
+        with pq.ParquetWriter(output_path, schema) as writer:
+            yield lambda batch: writer.write_table(pa.table({
+                'seq': [seq for _, seq in batch],
+                'id': [id for id, _ in batch],
+            }, schema=schema))
+    else:
+        with open(output_path, 'wt', buffering=WRITE_BUFFER) as o:
+            yield lambda batch: o.writelines(f'{seq}\t{id}\n' for id, seq in batch)
+
+
+def convert_fastq(fastq_path, write, threads=1, batch_size=WRITE_BATCH):
+    reads = read_fastq(fastq_path, threads)
+    written = 0
+    while True:
+        batch = [(id, seq) for id, seq, _ in islice(reads, batch_size)]
+        if not batch:
+            break
+        write(batch)
+        written += len(batch)
+    return written
+
+
+def write_shard(fastq_path, shard_path, threads=1, output_format='tsv'):
+    with open_writer(shard_path, output_format) as write:
+        return convert_fastq(fastq_path, write, threads, WRITE_BATCHES[output_format])
+
+
+def concat_shards(shard_paths, output_path, output_format='tsv'):
+    if output_format == 'parquet':
+        import pyarrow.parquet as pq
+
+        with pq.ParquetWriter(output_path, pq.ParquetFile(shard_paths[0]).schema_arrow) as writer:
+            for shard_path in shard_paths:
+                shard = pq.ParquetFile(shard_path)
+                for i in range(shard.num_row_groups):
+                    writer.write_table(shard.read_row_group(i))
+    else:
+        with open(output_path, 'wb') as o:
+            for shard_path in shard_paths:
+                with open(shard_path, 'rb') as f:
+                    shutil.copyfileobj(f, o, WRITE_BUFFER)
+
+
+def list_fastqs(input_path):
+    return sorted(join(input_path, f) for f in listdir(input_path) if 'merged.fastq' in f and isfile(join(input_path, f)))
+
+
+def write_reads(input_path, output_path, workers=1, output_format='tsv'):
     try:
-        fastq_paths = sorted(join(input_path, f) for f in listdir(input_path) if 'merged.fastq' in f and isfile(join(input_path, f)))
+        fastq_paths = list_fastqs(input_path)
     except FileNotFoundError:
         return {
             'fastqs': -1,
             'reads': -1,
         }
 
-    with open(output_path, 'wt') as o:
-    
-        for fastq_path in fastq_paths:
-            reads = read_fastq(fastq_path)
-            for read in reads:
-                row = f"{read['seq']}\t{read['id']}\n"
-                o.write(row)
+    if output_format == 'parquet' and output_path.endswith('.tsv'):
+        output_path = output_path[:-len('.tsv')] + '.parquet'
+
+    if workers <= 1 or not fastq_paths:
+        with open_writer(output_path, output_format) as write:
+            reads = sum(convert_fastq(fastq_path, write, batch_size=WRITE_BATCHES[output_format]) for fastq_path in fastq_paths)
+        return {
+            'fastqs': len(fastq_paths),
+            'reads': reads,
+        }
+
+    # Convert files in parallel into per-file shards, spare workers go to
+    # decompression threads, then concatenate the shards in sorted file order
+    shard_dir = f'{output_path}.shards'
+    makedirs(shard_dir, exist_ok=True)
+    shard_paths = [join(shard_dir, f'{i}.{output_format}') for i in range(len(fastq_paths))]
+    threads = max(1, workers // len(fastq_paths))
+    try:
+        with ProcessPoolExecutor(min(workers, len(fastq_paths))) as executor:
+            reads = sum(executor.map(write_shard, fastq_paths, shard_paths, repeat(threads), repeat(output_format)))
+        concat_shards(shard_paths, output_path, output_format)
+    finally:
+        shutil.rmtree(shard_dir)
+    return {
+        'fastqs': len(fastq_paths),
+        'reads': reads,
+    }
+
+
+def main():
+    # Parse the command-line arguments
+    args = parse_arguments().parse_args()
+    fastq_path = args.fastq_path
+    output_path = args.output_path      # called as    dir/fastq.tsv
+    workers = args.workers
+    output_format = args.output_format
 
+    profile = metrics.start_profile(args.profile)
 
+    #output_path_file = f'{output_path}/fastq.tsv'
+    with metrics.stage('convert') as stage:
+        written = write_reads(fastq_path, output_path, workers, output_format)
+        stage['rows_out'] = max(0, written['reads'])
+    print(written)
+    metrics.finish('fastq2tsv', args.metrics, profile, args.profile)
 
-# Parse the command-line arguments
-args = parse_arguments().parse_args()
-fastq_path = args.fastq_path
-output_path = args.output_path      # called as    dir/fastq.tsv     
 
-#output_path_file = f'{output_path}/fastq.tsv'
-print(write_reads(fastq_path, output_path))
\ No newline at end of file
+if __name__ == "__main__":
+    main()
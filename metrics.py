@@ -0,0 +1,107 @@
+# Per-stage wall time, CPU time, peak RSS and throughput of STRAT scripts
+from contextlib import contextmanager
+import json
+import sys
+import time
+
+
+STAGES = []
+
+COLUMNS = ['script', 'stage', 'calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rows_in', 'rows_out', 'reads_per_s']
+
+
+def cpu_time():
+    # CPU time of this process and of its finished child processes
+    import resource
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb():
+    # Peak resident memory of this process or any finished child process,
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    import resource
+
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+
+
+@contextmanager
+def stage(name, rows_in=0, stages=STAGES):
+    # Record of a named stage, rows_out defaults to rows_in and can be set on
+    # the yielded record once known
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    wall = time.perf_counter()
+    cpu = cpu_time()
+    yield record
+    record['wall_s'] = time.perf_counter() - wall
+    record['cpu_s'] = cpu_time() - cpu
+    record['peak_rss_mb'] = peak_rss_mb()
+    if record['rows_out'] is None:
+        record['rows_out'] = record['rows_in']
+    stages.append(record)
+
+
+def iterate(name, items, stages=STAGES):
+    # Items of an iterable (ex. chunks of a table), producing each one recorded
+    # as a stage with the item length as rows out
+    items = iter(items)
+    while True:
+        record = []
+        with stage(name, stages=record) as current:
+            item = next(items, None)
+            current['rows_out'] = 0 if item is None else len(item)
+        if item is None:
+            return
+        stages.extend(record)
+        yield item
+
+
+def summary(script, stages=STAGES):
+    # One row per stage name in first seen order, repeated stages (ex. one
+    # per chunk) summed
+    rows = {}
+    for record in stages:
+        row = rows.setdefault(record['stage'], dict.fromkeys(COLUMNS, 0))
+        row.update(script=script, stage=record['stage'], calls=row['calls'] + 1)
+        for column in ['wall_s', 'cpu_s', 'rows_in', 'rows_out']:
+            row[column] += record[column]
+        row['peak_rss_mb'] = max(row['peak_rss_mb'], record['peak_rss_mb'])
+    for row in rows.values():
+        # Loading stages have no rows in, their throughput is of rows out
+        rows_done = row['rows_in'] or row['rows_out']
+        row['reads_per_s'] = rows_done / row['wall_s'] if row['wall_s'] else None
+    return list(rows.values())
+
+
+def write(output_path, script, stages=STAGES):
+    # Stage summary as JSON or TSV, by extension
+    rows = summary(script, stages)
+    with open(output_path, 'w') as o:
+        if output_path.endswith('.json'):
+            json.dump(rows, o, indent=2)
+        else:
+            o.write('\t'.join(COLUMNS) + '\n')
+            o.writelines('\t'.join('' if row[column] is None else str(row[column]) for column in COLUMNS) + '\n' for row in rows)
+
+
+def start_profile(profile_path):
+    if not profile_path:
+        return None
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def finish(script, metrics_path=None, profile=None, profile_path=None):
+    # Dump the cProfile stats and write the stage metrics, where asked for
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(profile_path)
+        print(f'Written profile of {script} to {profile_path}')
+    if metrics_path:
+        write(metrics_path, script)
+        print(f'Written metrics of {script} to {metrics_path}')
@@ -1,15 +1,34 @@
 from os.path import isfile, join
 import argparse
-import matplotlib.pyplot as plt
-import matplotlib.ticker as plticker
+import numpy as np
 import pandas as pd
-import seaborn as sns
 
 import common
+import metrics
 
 pd.set_option('display.max_columns', 14)
 pd.set_option('display.max_rows', 10)
 
+COLUMNS_PROCESSED_PLOTS = ['direction', 'len_ins_ext_aln', 'ins_ext_aln']
+
+WATERFALL_BATCH = 500
+
+MOTIF = 'CAG'
+
+COLUMNS_FLANKS = ['id', 'prefix_flank', 'suffix_flank']
+
+READ_CHUNKSIZE = 100000
+
+FLANK_MASK = '0000000000'
+
+SEED = 42
+
+LIMIT_NT = 150
+
+WATERFALL_SAMPLE = 1000
+
+BASES_TABLE = str.maketrans('ACGT', '____')
+
 COLORS = {
     '6': '#7777FF',  # light blue
     '5': '#5555FF',  # blue
@@ -19,18 +38,32 @@ COLORS = {
     '_': '#333333',  # dark grey
 }
 
-COMPLEMENT = {
-    'A': 'T',
-    'C': 'G',
-    'G': 'C',
-    'T': 'A'
-}
+def palette(colors):
+    # RGB lookup table indexed by base, and which bases have a color
+    from PIL import ImageColor
+
+    lut = np.zeros((256, 3), dtype=np.uint8)
+    known = np.zeros(256, dtype=bool)
+    for n, color in colors.items():
+        lut[ord(n)] = ImageColor.getrgb(color)
+        known[ord(n)] = True
+    return lut, known
+
+
+def check_colors(codes, drawn, known):
+    unknown = drawn & ~known[codes]
+    if unknown.any():
+        raise KeyError(chr(codes[unknown][0]))
+
+
+def line_columns(x, width):
+    # Columns covered by a vertical ImageDraw line of this width centred on x
+    return x - (width - 1) // 2 + np.arange(width)
 
-def rev_comp(seq, comps):
-    return ''.join(comps.get(n, n) for n in reversed(seq))
 
 def plot_waterfall_processed(df, col_len, col_seq, stretch, grid, output_path):
-    
+    from PIL import Image, ImageColor
+
     width = min(1500, df[col_len].max())
     
     cond = df['direction'] == 'fwd'
@@ -45,77 +78,122 @@ def plot_waterfall_processed(df, col_len, col_seq, stretch, grid, output_path):
 
     width = (width)*stretch+stretch
     height = len(inss)
-    image = common.Image.new('RGB', (width, height), 'grey')
-    draw = common.ImageDraw.Draw(image)
-    bottom = 0
-    for i, seq in enumerate(inss):
-        y = i
-        # for j, n in enumerate(reversed(seq)):
-        for j, n in enumerate(seq):
-            x = j + 1
-            N = 'CAG'[j%3]
-            if n == N:
-                color = 'black'
-            else:
-                color = common.COLORS[n]
-            draw.line([(stretch*x, y), (stretch*x, y+1)], width=stretch, fill=color)
-
-    for i in range(width):
-        y = stretch*i+stretch//2
-        if i % 3 == 0:
-            draw.line([(y, 0), (y, height)], width=grid, fill='#AAAAAA')
-    
-        if i % 30 == 0:
-            draw.line([(y, 0), (y, height)], width=grid, fill='white')
 
-        if i % 300 == 0:
-            draw.line([(y, 0), (y, height)], width=grid, fill='black')
-
-    image.save(output_path)
-
-
-def plot_waterfalls_processed(df, output_path):
+    # Base colors, with bases matching the CAG frame in black
+    lens = np.array([len(seq) for seq in inss])
+    codes = common.encode(inss, lens.max())
+    drawn = np.arange(codes.shape[1]) < lens[:, None]
+    frame = np.frombuffer(('CAG' * (codes.shape[1] // 3 + 1)).encode('ascii'), dtype=np.uint8)[:codes.shape[1]]
+    in_frame = codes == frame
+    lut, known = palette(common.COLORS)
+    check_colors(codes, drawn & ~in_frame, known)
+    cells = np.where(in_frame[:, :, None], np.uint8(0), lut[codes])
+
+    # Each base is a line from its row to the next one, so a row keeps the
+    # previous row's bases where it has none of its own
+    grey = ImageColor.getrgb('grey')
+    rows = np.full(cells.shape, grey, dtype=np.uint8)
+    rows[1:][drawn[:-1]] = cells[:-1][drawn[:-1]]
+    rows[drawn] = cells[drawn]
+
+    image = np.full((height, width, 3), grey, dtype=np.uint8)
+    left = line_columns(stretch, stretch)[0]
+    block = np.repeat(rows, stretch, axis=1)[:, :max(0, width - left)]
+    image[:, left:left + block.shape[1]] = block
+
+    # Grid every 3, 30 and 300 bases
+    for step, color in [(3, '#AAAAAA'), (30, 'white'), (300, 'black')]:
+        columns = line_columns(stretch * np.arange(0, width, step)[:, None] + stretch // 2, grid).ravel()
+        image[:, columns[(columns >= 0) & (columns < width)]] = ImageColor.getrgb(color)
+
+    Image.fromarray(image).save(output_path)
+
+
+def plot_waterfalls_processed(counts, kept, output_path, limit_nt=LIMIT_NT, sample_size=WATERFALL_SAMPLE, seed=SEED):
     col_seq = 'ins_ext_aln'
     col_len = 'len_' + col_seq
 
-    cond = df[col_len] <= 150
-    if len(df[cond]) > 0:
-        df_sampled = df[cond].sample(n=1000, replace=True, random_state=42)
-        output_path_50 = f'{output_path}.wtrf.50.png'
-        plot_waterfall_processed(df_sampled, col_len, col_seq, 15, 2, output_path_50)
-
-    cond = df[col_len] > 150
-    if len(df[cond]) > 0:
-        df_sampled = df[cond].sample(n=1000, replace=True, random_state=42)
-        output_path_51 = f'{output_path}.wtrf.51.png'
-        plot_waterfall_processed(df_sampled, col_len, col_seq, 7, 1, output_path_51)
-
-def prepare_row_for_waterfall(row):
-    plt_seq = row['seq']
-    
-    if not pd.isna(row['prefix_flank']):
-        # print(row['prefix_flank'])
-        plt_seq = plt_seq.replace(row['prefix_flank'], '0000000000')
-        plt_seq = plt_seq.replace(row['suffix_flank'], '0000000000')
-    
-    plt_seq = plt_seq.replace('CTGCTG', '666666')
-    plt_seq = plt_seq.replace('CAGCAG', '333333')
-    plt_seq = plt_seq.replace('CTG', '555')
-    plt_seq = plt_seq.replace('CAG', '444')
-
-    plt_seq = plt_seq.replace('A', '_')
-    plt_seq = plt_seq.replace('T', '_')
-    plt_seq = plt_seq.replace('C', '_')
-    plt_seq = plt_seq.replace('G', '_')
-
-    return plt_seq
-
-
-def prepare_df_for_waterfall(df, sample_size=4000, max_len_seq=3500):
-    df['len_seq'] = df['seq'].str.len()
-    cond = df['len_seq'] <= max_len_seq
-    plt_df = df[cond].sample(sample_size, replace=True)
-    plt_df['plt_seq'] = plt_df.apply(prepare_row_for_waterfall, axis=1)
+    # Each allele's sample is split across directions as its inserts are
+    counts = counts.assign(allele=alleles(counts[col_len], limit_nt))
+    for allele, stretch, grid, suffix in [('wt', 15, 2, 50), ('exp', 7, 1, 51)]:
+        seen = counts[counts['allele'] == allele].groupby('direction')['count'].sum()
+        seen = seen[seen > 0]
+        if len(seen) > 0:
+            df_sampled = pd.concat([
+                draw(kept[(kept['allele'] == allele) & (kept['direction'] == direction)], n, seed)
+                for direction, n in zip(seen.index, allocate(seen.to_numpy(), sample_size))
+            ])
+            plot_waterfall_processed(df_sampled, col_len, col_seq, stretch, grid, f'{output_path}.wtrf.{suffix}.png')
+
+
+def alleles(lens, limit_nt=LIMIT_NT):
+    return np.where(lens <= limit_nt, 'wt', 'exp')
+
+
+def allocate(seen, sample_size):
+    # Sample size split proportionally to the rows seen in each stratum
+    bounds = np.round(sample_size * np.cumsum(seen) / np.sum(seen)).astype(int)
+    return np.diff(bounds, prepend=0)
+
+
+def reservoir_update(kept, chunk, sample_size, rng, strata=None):
+    # Bottom-k reservoir - every row gets a uniform random key and each stratum
+    # keeps its sample_size lowest keys, a sample without replacement that does
+    # not depend on how the rows are chunked
+    chunk = chunk.assign(key=rng.random(len(chunk)))
+    if kept is not None:
+        chunk = pd.concat([kept, chunk], ignore_index=True)
+    chunk = chunk.sort_values('key', kind='stable')
+    if strata:
+        return chunk.groupby(strata, sort=False).head(sample_size)
+    return chunk.head(sample_size)
+
+
+def draw(kept, n, seed=SEED):
+    # n rows of a reservoir, with replacement when fewer rows were seen
+    if len(kept) >= n:
+        return kept.head(n)
+    return kept.sample(n, replace=True, random_state=seed)
+
+
+def sample_processed(chunks, limit_nt=LIMIT_NT, sample_size=WATERFALL_SAMPLE, seed=SEED):
+    # One pass over processed inserts - insert length counts per direction for
+    # the histograms and a reservoir per direction and allele for the waterfalls
+    rng = np.random.default_rng(seed)
+    counts = None
+    kept = None
+    for chunk in chunks:
+        # Columnar tables keep direction categorical, which would reorder the hues
+        chunk = chunk[COLUMNS_PROCESSED_PLOTS].astype({'direction': str})
+        size = chunk.groupby(['direction', 'len_ins_ext_aln']).size()
+        counts = size if counts is None else pd.concat([counts, size]).groupby(level=[0, 1]).sum()
+        chunk = chunk.assign(allele=alleles(chunk['len_ins_ext_aln'], limit_nt))
+        kept = reservoir_update(kept, chunk, sample_size, rng, ['direction', 'allele'])
+    return counts.rename('count').reset_index(), kept
+
+
+def waterfall_codes(motif=MOTIF):
+    # Repeat blocks in the order they are recoded - doubled blocks before
+    # single ones, reverse complemented motif before the motif
+    motif_rc = common.rev_comp(motif)
+    return [(motif_rc * 2, '6'), (motif * 2, '3'), (motif_rc, '5'), (motif, '4')]
+
+
+def prepare_seqs_for_waterfall(df, motif=MOTIF):
+    # Flanks differ per read and are masked one read at a time, repeat
+    # blocks and remaining bases are recoded for all reads at once
+    seqs = pd.Series([
+        seq.replace(prefix_flank, FLANK_MASK).replace(suffix_flank, FLANK_MASK) if flanked else seq
+        for seq, prefix_flank, suffix_flank, flanked in zip(df['seq'], df['prefix_flank'], df['suffix_flank'], df['prefix_flank'].notna())
+    ], index=df.index, dtype=str)
+    for block, code in waterfall_codes(motif):
+        seqs = seqs.str.replace(block, code * len(block), regex=False)
+    return seqs.str.translate(BASES_TABLE)
+
+
+def order_for_waterfall(plt_df, motif=MOTIF):
+    plt_df['len_seq'] = plt_df['seq'].str.len()
+    plt_df['plt_seq'] = prepare_seqs_for_waterfall(plt_df, motif)
     #plt_df['fwd'] = plt_df['plt_seq'].str.count('6')
     #plt_df['rev'] = plt_df['plt_seq'].str.count('3')
     
@@ -134,32 +212,65 @@ def prepare_df_for_waterfall(df, sample_size=4000, max_len_seq=3500):
     return plt_df
 
 
-def plot_waterfall(df, col_len, col_seq, output_path):
+def reservoir_reads(chunks, sample_size=4000, max_len_seq=3500, seed=SEED):
+    # Reads of at most max_len_seq sampled in one pass
+    rng = np.random.default_rng(seed)
+    kept = None
+    for chunk in chunks:
+        kept = reservoir_update(kept, chunk[chunk['seq'].str.len() <= max_len_seq], sample_size, rng)
+    return draw(kept, sample_size, seed)
+
+
+def sample_reads(df_fastq, df_ontarget, sample_size=4000, max_len_seq=3500, seed=SEED):
+    # Sampled reads with the flanks of their on-target inserts
+    reads = reservoir_reads([df_fastq], sample_size, max_len_seq, seed)
+    flanks = df_ontarget[df_ontarget['id'].isin(reads['id'])][COLUMNS_FLANKS]
+    return reads.merge(flanks, on='id', how='left')
+
+
+def sample_reads_from_files(fastq_tsv, ontarget_tsv, sample_size=4000, max_len_seq=3500, chunksize=READ_CHUNKSIZE, seed=SEED):
+    # Reads sampled in one pass and their flanks by a semi-join on the sampled
+    # IDs, never holding all reads
+    chunks = common.read_table_chunks(fastq_tsv, None, chunksize, columns=['seq', 'id'])
+    reads = reservoir_reads(chunks, sample_size, max_len_seq, seed)
+
+    ids = set(reads['id'])
+    flanks = pd.concat([
+        chunk[chunk['id'].isin(ids)]
+        for chunk in common.read_table_chunks(ontarget_tsv, COLUMNS_FLANKS, chunksize, columns=common.COLUMNS_PREPARED)
+    ], ignore_index=True)
+    return reads.merge(flanks, on='id', how='left')
+
+
+def plot_waterfall(df, col_len, col_seq, output_path, batch_size=WATERFALL_BATCH):
+    from PIL import Image, ImageColor
+
     width = df[col_len].max()
     height = len(df)
 
     inss = list(df[col_seq])
 
-    image = common.Image.new('RGB', (width, height), 'grey')
-    draw = common.ImageDraw.Draw(image)
-    bottom = 0
-    for i, seq in enumerate(inss):
-        y = i
-        half = len(seq) / 2
-        # left = 0
-        left = (width - len(seq)) // 2
-        # right = width - len(seq)
-        for j, n in enumerate(seq):
-            color = COLORS[n]
-            draw.point([left+j, i], fill=color)
-            # if j < half:
-            #     draw.point([left+j, i], fill=color)
-            # else:
-            #     draw.point([right+j, i], fill=color)
-
-    image.save(output_path)
+    # Reads centred on their rows, clipped to the image
+    image = np.full((height, width, 3), ImageColor.getrgb('grey'), dtype=np.uint8)
+    lut, known = palette(COLORS)
+    for start in range(0, height, batch_size):
+        batch = inss[start:start + batch_size]
+        lens = np.array([len(seq) for seq in batch])
+        codes = common.encode(batch, lens.max())
+        drawn = np.arange(codes.shape[1]) < lens[:, None]
+        check_colors(codes, drawn, known)
+        x = (width - lens[:, None]) // 2 + np.arange(codes.shape[1])
+        drawn &= (x >= 0) & (x < width)
+        y = np.broadcast_to(np.arange(start, start + len(batch))[:, None], x.shape)
+        image[y[drawn], x[drawn]] = lut[codes[drawn]]
+
+    Image.fromarray(image).save(output_path)
 
 def plot_histogram(df, x, hue, base, output_histogram):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+    import seaborn as sns
+
     fig, ax = plt.subplots(figsize=(16, 10))
 
     # Create the histogram
@@ -178,9 +289,13 @@ def plot_histogram(df, x, hue, base, output_histogram):
     # Optionally, close the figure to release memory
     plt.close(fig)
 
-def plot_histogram(df, x, hue, base, output_histogram):
+def plot_histogram(df, x, hue, base, output_histogram, weights=None):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+    import seaborn as sns
+
     fig, ax = plt.subplots(figsize=(16, 10))
-    gfg = sns.histplot(df, x=x, discrete=True, hue=hue, multiple='stack')
+    gfg = sns.histplot(df, x=x, discrete=True, hue=hue, multiple='stack', weights=weights)
     # gfg.set_xlim(0, 1000)
     # gfg.set_yscale("log")
     loc = plticker.MultipleLocator(base=base)
@@ -188,20 +303,19 @@ def plot_histogram(df, x, hue, base, output_histogram):
     gfg.set_xticks(gfg.get_xticks())  # Set the ticks first
     gfg.set_xticklabels(gfg.get_xticklabels(), rotation=90)
     fig.savefig(output_histogram)
+    plt.close(fig)
 
-def plot_histograms(df, x, output_path):
+def plot_histograms(df, x, output_path, weights=None):
     cond = df[x] <= 50
     if len(df[cond]) > 0:
-        plot_histogram(df[cond].sort_values('direction', ascending=False), x, 'direction', 5, f'{output_path}.hist.50.png')
+        plot_histogram(df[cond].sort_values('direction', ascending=False), x, 'direction', 5, f'{output_path}.hist.50.png', weights)
     cond = df[x] > 50
     if len(df[cond]) > 0:
-        plot_histogram(df[cond].sort_values('direction', ascending=False), x, 'direction', 5, f'{output_path}.hist.51.png')
+        plot_histogram(df[cond].sort_values('direction', ascending=False), x, 'direction', 5, f'{output_path}.hist.51.png', weights)
 
 
 def load_fastq_tsv(path):
-    df = pd.read_csv(path, sep='\t', header=None)
-    df.columns = ['seq', 'id']
-    return df
+    return common.load_tsv(path, ['seq', 'id'])
 
 
 def load_ontarget(path):
@@ -213,8 +327,8 @@ def load_kmers(path):
     return common.load_tsv(path, cols)
 
 
-def load_processed(path):
-    return common.load_tsv(path)
+def load_processed(path, usecols=COLUMNS_PROCESSED_PLOTS):
+    return common.load_tsv(path, usecols=usecols)
 
 
 def load_kmers_processed(path):
@@ -229,9 +343,15 @@ def parse_arguments():
     #parser.add_argument('--limit', type=int, required=True, help='Pathogenic repeat number limit')
     parser.add_argument('--fastq_tsv_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
     parser.add_argument('--merged_ontarget_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
-    parser.add_argument('--raw_ontarget_merged_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
+    parser.add_argument('--raw_ontarget_merged_path', type=str, default=None, help='Path to directory to store the merged FASTQ and on-target table fastq.ontarget.tsv, only written when given (ex. "/data/outputs/")')
     parser.add_argument('--images_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
     parser.add_argument('--processed_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
+    parser.add_argument('--motif', type=str, default=MOTIF, help='Motif of the repeated block recoded in the waterfall (ex. "CAG")')
+    parser.add_argument('--chunksize', type=int, default=READ_CHUNKSIZE, help='Number of reads loaded at a time while sampling the waterfall (ex. "100000")')
+    parser.add_argument('--limit_nt', type=int, default=LIMIT_NT, help='Longest wild-type insert in nucleotides, longer inserts are expanded (ex. "150")')
+    parser.add_argument('--seed', type=int, default=SEED, help='Seed of the waterfall samples (ex. "42")')
+    parser.add_argument('--metrics', type=str, default=None, help='Path to JSON or TSV file with wall time, CPU time, peak memory and rows of every stage (ex. "/data/outputs/plots.metrics.tsv")')
+    parser.add_argument('--profile', type=str, default=None, help='Path to cProfile stats of the whole run (ex. "/data/outputs/plots.prof")')
 
     
     return parser
@@ -248,56 +368,82 @@ def load():
     raw_ontarget_merged_path = args.raw_ontarget_merged_path
     processed_path = args.processed_path
     images_path = args.images_path
+    motif = args.motif
+    limit_nt = args.limit_nt
+    seed = args.seed
+    profile = metrics.start_profile(args.profile)
 
-    path = f'{fastq_tsv_path}/fastq.tsv'   # ovo treba da se napravi i da se zove fastq.tsv
-    df_fastq = load_fastq_tsv(path)
-    reads = len(df_fastq)
-    
+    path_fastq = f'{fastq_tsv_path}/fastq.tsv'   # ovo treba da se napravi i da se zove fastq.tsv
+    path_ontarget = f'{merged_ontarget_path}/merged.ontarget.tsv' # merged ontarget tsv
+    print(path_ontarget)
 
-    path = f'{merged_ontarget_path}/merged.ontarget.tsv' # merged ontarget tsv
-    print(path)
-    df_ontarget = load_ontarget(path)
-    ontarget = len(df_ontarget)
-    cond = df_ontarget['direction'] == 'fwd'
-    ontarget_fwd = len(df_ontarget[cond])
-    ontarget_rev = ontarget - ontarget_fwd
-    
-    # Merge FASTQ and on-target dataframes
-    df = pd.merge(df_fastq, df_ontarget, how="outer", on=["id", "id"])
-    # save merged
-    path = f'{raw_ontarget_merged_path}/fastq.ontarget.tsv'
-    df.to_csv(path, sep='\t', index=False)
-    
+    path = f'{processed_path}/merged.ontarget.processed.tsv'
+
+    if raw_ontarget_merged_path is not None:
+        # The merged table needs all reads in memory
+        with metrics.stage('load') as stage:
+            df_fastq = load_fastq_tsv(path_fastq)
+            df_ontarget = load_ontarget(path_ontarget)
+            df_processed = load_processed(path)
+            stage['rows_out'] = len(df_fastq)
+        plot_sample(df_fastq, df_ontarget, df_processed, images_path, f'{raw_ontarget_merged_path}/fastq.ontarget.tsv', motif, limit_nt, seed)
+    else:
+        with metrics.stage('sample_reads') as stage:
+            plt_df = sample_reads_from_files(path_fastq, path_ontarget, chunksize=args.chunksize, seed=seed)
+            stage['rows_out'] = len(plt_df)
+        plot_reads(plt_df, images_path, motif)
+        plot_processed(common.read_table_chunks(path, COLUMNS_PROCESSED_PLOTS, args.chunksize), images_path, limit_nt, seed)
+    print('completed!\n')
+    print('*****************************************************************************')
+    metrics.finish('plots', args.metrics, profile, args.profile)
+
+
+# Waterfall of raw reads, histograms and waterfalls of processed inserts.
+# Reads are always sampled from the FASTQ table and joined with their flanks,
+# the merged FASTQ and on-target table is only saved when a path is given.
+def plot_sample(df_fastq, df_ontarget, df_processed, images_path, raw_ontarget_merged_path=None, motif=MOTIF, limit_nt=LIMIT_NT, seed=SEED):
+    if raw_ontarget_merged_path is not None:
+        with metrics.stage('merge', len(df_fastq)) as stage:
+            # Merge FASTQ and on-target dataframes
+            df = pd.merge(df_fastq, df_ontarget, how="outer", on=["id", "id"])
+            # save merged
+            df.to_csv(raw_ontarget_merged_path, sep='\t', index=False)
+            stage['rows_out'] = len(df)
+    with metrics.stage('sample_reads', len(df_fastq)) as stage:
+        plt_df = sample_reads(df_fastq, df_ontarget, seed=seed)
+        stage['rows_out'] = len(plt_df)
+    plot_reads(plt_df, images_path, motif)
+    plot_processed([df_processed], images_path, limit_nt, seed)
+
+
+def plot_reads(plt_df, images_path, motif=MOTIF):
     # Waterfall
-    plt_df = prepare_df_for_waterfall(df)
-    output_path = f'{images_path}/waterfall.png'
-    plot_waterfall(plt_df, 'len_seq', 'plt_seq', output_path)
+    with metrics.stage('waterfall', len(plt_df)):
+        plt_df = order_for_waterfall(plt_df, motif)
+        output_path = f'{images_path}/waterfall.png'
+        plot_waterfall(plt_df, 'len_seq', 'plt_seq', output_path)
 
-    limit = 150
-    path = f'{processed_path}/merged.ontarget.processed.tsv'
-    df_processed = load_processed(path)
-    cond_fwd = df_processed['direction'] == 'fwd'
-    cond_rev = df_processed['direction'] == 'rev'
-    df_processed['len'] = df_processed['len_ins_ext_aln'] / 3
-    cond = df_processed['len'] <= limit
-    processed_50_fwd = sum(cond & cond_fwd)
-    processed_50_rev = sum(cond & cond_rev)
-    percentiles_50 = df_processed[cond]['len'].quantile([0.1, 0.5, 0.9])
-    cond = df_processed['len'] > limit
-    processed_51_fwd = sum(cond & cond_fwd)
-    processed_51_rev = sum(cond & cond_rev)
-    percentiles_51 = df_processed[cond]['len'].quantile([0.1, 0.5, 0.9])
+
+# Histograms and waterfalls of processed inserts from one pass over chunks of
+# the processed table, holding only length counts and the waterfall samples
+def plot_processed(chunks, images_path, limit_nt=LIMIT_NT, seed=SEED):
+    with metrics.stage('sample_processed') as stage:
+        counts, kept = sample_processed(chunks, limit_nt, WATERFALL_SAMPLE, seed)
+        counts['len'] = counts['len_ins_ext_aln'] / 3
+        stage['rows_out'] = int(counts['count'].sum())
+    rows = stage['rows_out']
 
     # Histograms
 
     output_path = f'{images_path}'
-    plot_histograms(df_processed, 'len', output_path)
+    with metrics.stage('histograms', rows):
+        plot_histograms(counts, 'len', output_path, 'count')
 
     #Waterfalls
     output_path = f'{images_path}'
-    plot_waterfalls_processed(df_processed, output_path)
-    print('completed!\n')
-    print('*****************************************************************************')
-    
-    
-load()
\ No newline at end of file
+    with metrics.stage('waterfalls_processed', rows):
+        plot_waterfalls_processed(counts, kept, output_path, limit_nt, WATERFALL_SAMPLE, seed)
+
+
+if __name__ == "__main__":
+    load()
@@ -0,0 +1,366 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from glob import glob
+import hashlib
+import json
+from os import makedirs, remove, stat
+from os.path import abspath, basename, dirname, isdir, isfile, join, normpath
+import shutil
+import subprocess
+import sys
+
+import pandas as pd
+import yaml
+
+
+SCRIPT_DIR = dirname(abspath(__file__))
+
+REFERENCE = '/mnt/d/READ_DM1/DATA/REFERENCE/lambda.fasta'
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='STRAT Pipeline - run all STRAT stages for every sample directory, several samples in parallel')
+
+    # Define string parameters
+    parser.add_argument('input_dir', type=str, help='Path to directory containing sample subdirectories (ex. "/data/run1/")')
+    parser.add_argument('--config', type=str, default=join(SCRIPT_DIR, 'config.yaml'), help='Path to STRAT config file (ex. "./config.yaml")')
+    parser.add_argument('--reference', type=str, default=REFERENCE, help='Path to lambda reference genome (ex. "/data/reference/lambda.fasta")')
+    parser.add_argument('--threshold', type=int, default=1, help='Minimum number of inserts of each size passed to STRAT Process (ex. "100")')
+    parser.add_argument('--fit-mode', dest='fit_mode', type=str, default='pad', choices=['pad', 'align'], help='Fit fragments between motifs by padding them with I or by banded alignment to whole motifs in STRAT Process (ex. "align")')
+    parser.add_argument('--force-stage', dest='force_stage', type=str, nargs='+', default=[], choices=list(dict.fromkeys(STAGE_NAMES + FUSED_STAGE_NAMES)) + ['all'], help='Run these stages even if their outputs are up to date (ex. "plots summarize")')
+    parser.add_argument('--save-merged', dest='save_merged', action='store_true', help='Also write the merged FASTQ and on-target table fastq.ontarget.tsv of every sample')
+    parser.add_argument('--fused', action='store_true', help='Process, plot and summarize each sample in one in-memory stage instead of separate stages')
+    parser.add_argument('--metrics', action='store_true', help='Write wall time, CPU time, peak memory and rows of every stage of the STRAT scripts to {stage}.metrics.tsv in each sample directory, collected in pipeline.metrics.tsv')
+    parser.add_argument('--profile', action='store_true', help='Write cProfile stats of the STRAT scripts to {stage}.prof in each sample directory')
+    parser.add_argument('--cores', type=int, default=None, help='Number of samples processed in parallel, defaults to cores from the config file (ex. "8")')
+
+    return parser
+
+
+def log_line(log, message):
+    log.write(f'{datetime.now()} - STRAT Pipeline - {message}\n')
+    log.flush()
+
+
+def run(cmd, log, stdout=None):
+    log_line(log, ' '.join(cmd))
+    subprocess.run(cmd, stdout=stdout or log, stderr=log, check=True)
+
+
+def instrumentation(sample_dir, stage, args):
+    # Metrics and profile arguments of an instrumented STRAT script
+    return (['--metrics', join(sample_dir, f'{stage}.metrics.tsv')] if args.metrics else []) + \
+        (['--profile', join(sample_dir, f'{stage}.prof')] if args.profile else [])
+
+
+def merge_fastq(sample_dir, name, config, args, log):
+    fastq_paths = sorted(p for p in glob(join(sample_dir, '*fastq')) if basename(p) != 'merged.fastq')
+    with open(join(sample_dir, 'merged.fastq'), 'wb') as o:
+        for fastq_path in fastq_paths:
+            with open(fastq_path, 'rb') as f:
+                shutil.copyfileobj(f, o)
+    log_line(log, f'Merged {len(fastq_paths)} FASTQ files')
+
+
+def lambda_alignment(sample_dir, name, config, args, log):
+    output_dir = join(sample_dir, 'lambda_alignment')
+    makedirs(output_dir, exist_ok=True)
+    run([
+        'bash', join(SCRIPT_DIR, 'lambda_alignment_summary.sh'),
+        join(sample_dir, 'merged.fastq'),
+        args.reference,
+        output_dir,
+        name,
+    ], log)
+
+
+def unaligned_fastq(sample_dir, name, config, args, log):
+    output_dir = join(sample_dir, 'unaligned_output')
+    makedirs(output_dir, exist_ok=True)
+    unaligned_bams = sorted(glob(join(sample_dir, 'lambda_alignment', '*_unaligned.bam')))
+    if not unaligned_bams:
+        log_line(log, f'No unaligned BAM files found in {sample_dir}/lambda_alignment')
+        return
+    with open(join(output_dir, f'{name}.fastq'), 'wb') as o:
+        run(['samtools', 'fastq', unaligned_bams[0]], log, stdout=o)
+
+
+def prepare(sample_dir, name, config, args, log):
+    # On-target inserts are written next to the sample as *.fastq.ontarget.tsv
+    # and merged into merged.ontarget.tsv, the tracked output of the stage
+    run([
+        sys.executable, join(SCRIPT_DIR, 'strat_prepare.py'),
+        '--config', args.config,
+        '--input_path', join(sample_dir, 'unaligned_output'),
+        '--output_path', sample_dir,
+        '--cores', str(args.sample_cores),
+    ], log)
+    merge_ontarget(sample_dir, log)
+
+
+def merge_ontarget(sample_dir, log):
+    ontarget_paths = sorted(glob(join(sample_dir, '*.fastq.ontarget.tsv')))
+    if not ontarget_paths:
+        log_line(log, f'No .fastq.ontarget.tsv files found in {sample_dir}')
+        return
+    with open(join(sample_dir, 'merged.ontarget.tsv'), 'wb') as o:
+        for ontarget_path in ontarget_paths:
+            with open(ontarget_path, 'rb') as f:
+                shutil.copyfileobj(f, o)
+    for ontarget_path in ontarget_paths:
+        remove(ontarget_path)
+    log_line(log, f'Merged {len(ontarget_paths)} on-target files')
+
+
+def process(sample_dir, name, config, args, log):
+    run([
+        sys.executable, join(SCRIPT_DIR, 'strat_process.py'),
+        '--motif_prim', config['motif'],
+        '--motif_scnd', config['motif'],
+        '--threshold', str(args.threshold),
+        '--fit_mode', args.fit_mode,
+        '--input_path', join(sample_dir, 'merged.ontarget.tsv'),
+        '--output_path', f'{sample_dir}/',
+    ] + instrumentation(sample_dir, 'process', args), log)
+
+
+def fastq2tsv(sample_dir, name, config, args, log):
+    run([
+        sys.executable, join(SCRIPT_DIR, 'fastq2tsv.py'),
+        '--fastq_path', sample_dir,
+        '--output_path', join(sample_dir, 'fastq.tsv'),
+    ] + instrumentation(sample_dir, 'fastq2tsv', args), log)
+
+
+def plots(sample_dir, name, config, args, log):
+    run([
+        sys.executable, join(SCRIPT_DIR, 'plots.py'),
+        '--fastq_tsv_path', sample_dir,
+        '--merged_ontarget_path', sample_dir,
+        '--images_path', sample_dir,
+        '--processed_path', sample_dir,
+        '--motif', config['motif'],
+        '--limit_nt', str(config['limit_nt']),
+    ] + (['--raw_ontarget_merged_path', sample_dir] if args.save_merged else []) + instrumentation(sample_dir, 'plots', args), log)
+
+
+def summarize(sample_dir, name, config, args, log):
+    run([
+        sys.executable, join(SCRIPT_DIR, 'summarize.py'),
+        '--lambda_alignment_summary', join(sample_dir, 'lambda_alignment', 'lambda_alignment_summary.tsv'),
+        '--strat_process_output', join(sample_dir, 'merged.ontarget.processed.tsv'),
+        '--output_dir_path', f'{sample_dir}/',
+        '--limit_nt', str(config['limit_nt']),
+    ] + instrumentation(sample_dir, 'summarize', args), log)
+
+
+def analyze(sample_dir, name, config, args, log):
+    run([
+        sys.executable, join(SCRIPT_DIR, 'strat_run.py'),
+        '--motif_prim', config['motif'],
+        '--motif_scnd', config['motif'],
+        '--threshold', str(args.threshold),
+        '--limit_nt', str(config['limit_nt']),
+        '--fit_mode', args.fit_mode,
+        '--input_path', join(sample_dir, 'merged.ontarget.tsv'),
+        '--fastq_path', sample_dir,
+        '--lambda_alignment_summary', join(sample_dir, 'lambda_alignment', 'lambda_alignment_summary.tsv'),
+        '--output_path', sample_dir,
+        '--sample_name', name,
+    ] + (['--export', 'processed', 'consensus', 'fastq_ontarget'] if args.save_merged else []) + instrumentation(sample_dir, 'analyze', args), log)
+
+
+# Stage name, function, input and output globs relative to the sample directory,
+# scripts the stage runs and config/argument values it depends on. Globs may
+# use {name}, the sample name - histograms and waterfalls of processed inserts
+# are written next to the sample directory.
+STAGES = [
+    ('merge_fastq', merge_fastq, ['*fastq'], ['merged.fastq'], [], []),
+    ('lambda_alignment', lambda_alignment, ['merged.fastq'], ['lambda_alignment/*'], ['lambda_alignment_summary.sh'], ['reference']),
+    ('unaligned_fastq', unaligned_fastq, ['lambda_alignment/*_unaligned.bam'], ['unaligned_output/*.fastq'], [], []),
+    ('prepare', prepare, ['unaligned_output/*.fastq'], ['merged.ontarget.tsv'], ['strat_prepare.py', 'fastq2tsv.py', 'common.py'], ['prefix', 'suffix', 'tolerance']),
+    ('process', process, ['merged.ontarget.tsv'], ['merged.ontarget.processed*.tsv', 'inserts.ontarget.ext.png'], ['strat_process.py', 'common.py'], ['motif', 'threshold', 'fit_mode']),
+    ('fastq2tsv', fastq2tsv, ['*merged.fastq*'], ['fastq.tsv'], ['fastq2tsv.py'], []),
+    ('plots', plots, ['fastq.tsv', 'merged.ontarget.tsv', 'merged.ontarget.processed.tsv'], ['waterfall.png', '../{name}.hist.5[01].png', '../{name}.wtrf.5[01].png', 'fastq.ontarget.tsv'], ['plots.py', 'common.py'], ['motif', 'limit_nt', 'save_merged']),
+    ('summarize', summarize, ['lambda_alignment/lambda_alignment_summary.tsv', 'merged.ontarget.processed.tsv'], ['merged_output*.csv', '{name}_wt.png', '{name}_exp.png'], ['summarize.py'], ['limit_nt']),
+]
+
+# Process, plots and summarize in one process, sharing the loaded tables
+FUSED_STAGES = STAGES[:4] + [
+    ('analyze', analyze, ['merged.ontarget.tsv', '*merged.fastq*', 'lambda_alignment/lambda_alignment_summary.tsv'], ['merged.ontarget.processed*.tsv', 'inserts.ontarget.ext.png', 'waterfall.png', '../{name}.hist.5[01].png', '../{name}.wtrf.5[01].png', 'fastq.ontarget.tsv', 'merged_output*.csv', '{name}_wt.png', '{name}_exp.png'], ['strat_run.py', 'strat_process.py', 'plots.py', 'summarize.py', 'fastq2tsv.py', 'common.py'], ['motif', 'threshold', 'limit_nt', 'save_merged', 'fit_mode']),
+]
+
+STAGE_NAMES = [stage for stage, *_ in STAGES]
+
+FUSED_STAGE_NAMES = [stage for stage, *_ in FUSED_STAGES]
+
+
+def file_hash(path, files):
+    # Content hash of a file, reused from the manifest while size and mtime are unchanged
+    st = stat(path)
+    entry = files.get(path)
+    if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+        return entry
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': h.hexdigest()}
+
+
+def snapshot(paths, files):
+    hashes = {}
+    for path in sorted(paths):
+        files[path] = file_hash(path, files)
+        hashes[path] = files[path]['sha256']
+    return hashes
+
+
+def glob_files(sample_dir, patterns):
+    name = basename(sample_dir)
+    return set(normpath(p) for pattern in patterns for p in glob(join(sample_dir, pattern.format(name=name))) if isfile(p))
+
+
+def stage_signature(sample_dir, inputs, outputs, scripts, params, config, args, files):
+    # Hash of everything a stage depends on - input files (excluding its own
+    # outputs), the scripts it runs and its parameters
+    values = {**config, **vars(args)}
+    signature = {
+        'inputs': snapshot(glob_files(sample_dir, inputs) - glob_files(sample_dir, outputs), files),
+        'scripts': snapshot([join(SCRIPT_DIR, script) for script in scripts if isfile(join(SCRIPT_DIR, script))], files),
+        'params': {param: values.get(param) for param in params},
+    }
+    return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(sample_dir):
+    path = join(sample_dir, 'pipeline.manifest.json')
+    if not isfile(path):
+        return {'files': {}, 'stages': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(sample_dir, manifest):
+    with open(join(sample_dir, 'pipeline.manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def collect_metrics(sample_dir, stage_names):
+    # Metrics of the instrumented stages of a sample in one table, stages up
+    # to date keep the metrics of their last run
+    paths = [join(sample_dir, f'{stage}.metrics.tsv') for stage in stage_names]
+    frames = [pd.read_csv(path, sep='\t') for path in paths if isfile(path)]
+    if not frames:
+        return None
+    df_metrics = pd.concat(frames, ignore_index=True)
+    df_metrics.to_csv(join(sample_dir, 'pipeline.metrics.tsv'), sep='\t', index=False)
+    return df_metrics
+
+
+def run_sample(sample_dir, config, args):
+    # Run the stages of one sample in order, stopping at the first failure.
+    # A stage is skipped when its signature and outputs match the manifest,
+    # unless it is forced. The status of every stage is written next to the
+    # sample outputs.
+    name = basename(sample_dir)
+    stages = FUSED_STAGES if args.fused else STAGES
+    stage_names = [stage for stage, *_ in stages]
+    status = {stage: 'skipped' for stage in stage_names}
+    force = set(stage_names) if 'all' in args.force_stage else set(args.force_stage)
+    manifest = load_manifest(sample_dir)
+    files = manifest['files']
+    with open(join(sample_dir, 'pipeline.log'), 'a') as log:
+        log_line(log, f'Start {name}')
+        for stage, func, inputs, outputs, scripts, params in stages:
+            start = datetime.now()
+            try:
+                signature = stage_signature(sample_dir, inputs, outputs, scripts, params, config, args, files)
+                recorded = manifest['stages'].get(stage)
+                if stage not in force and recorded and recorded['signature'] == signature \
+                        and snapshot(glob_files(sample_dir, outputs), files) == recorded['outputs']:
+                    status[stage] = 'up-to-date'
+                    log_line(log, f'Stage {stage} up to date')
+                    continue
+
+                func(sample_dir, name, config, args, log)
+                manifest['stages'][stage] = {
+                    'signature': signature,
+                    'outputs': snapshot(glob_files(sample_dir, outputs), files),
+                }
+            except Exception as e:
+                status[stage] = 'failed'
+                manifest['stages'].pop(stage, None)
+                log_line(log, f'Stage {stage} failed - {e}')
+                break
+            status[stage] = 'done'
+            log_line(log, f'Stage {stage} done in {datetime.now() - start}')
+        log_line(log, f'End {name}')
+
+    manifest['files'] = {path: entry for path, entry in files.items() if isfile(path)}
+    save_manifest(sample_dir, manifest)
+    df_status = pd.DataFrame(list(status.items()), columns=['stage', 'status'])
+    df_status.to_csv(join(sample_dir, 'pipeline.status.tsv'), sep='\t', index=False)
+    if args.metrics:
+        collect_metrics(sample_dir, stage_names)
+    return name, status
+
+
+def main():
+    # Parse the command-line arguments
+    args = parse_arguments().parse_args()
+    args.config = abspath(args.config)
+    input_dir = args.input_dir.rstrip('/')
+
+    if not isdir(input_dir):
+        print(f'{input_dir} is not a valid directory')
+        sys.exit(1)
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    cores = args.cores or config['cores']
+    stage_names = FUSED_STAGE_NAMES if args.fused else STAGE_NAMES
+
+    sample_dirs = sorted(d.rstrip('/') for d in glob(join(input_dir, '*/')))
+    # Cores of the samples running at once are shared by their STRAT Prepare workers
+    args.sample_cores = max(1, cores // max(1, min(cores, len(sample_dirs))))
+    print(f'{datetime.now()} - STRAT Pipeline - Processing {len(sample_dirs)} samples on {cores} cores')
+
+    statuses = {}
+    with ProcessPoolExecutor(max_workers=cores) as executor:
+        futures = {executor.submit(run_sample, sample_dir, config, args): sample_dir for sample_dir in sample_dirs}
+        for future in as_completed(futures):
+            name = basename(futures[future])
+            try:
+                name, status = future.result()
+            except Exception as e:
+                status = {stage: 'failed' if i == 0 else 'skipped' for i, stage in enumerate(stage_names)}
+                print(f'{datetime.now()} - STRAT Pipeline - Sample {name} crashed - {e}')
+            statuses[name] = status
+            failed = [stage for stage, s in status.items() if s == 'failed']
+            result = f'failed at {failed[0]}' if failed else 'done'
+            print(f'{datetime.now()} - STRAT Pipeline - Sample {name} {result} ({len(statuses)}/{len(sample_dirs)})')
+
+    # Stage status of all samples, one row per sample
+    df_status = pd.DataFrame.from_dict(statuses, orient='index', columns=stage_names)
+    df_status.index.name = 'sample'
+    output_status = join(input_dir, 'pipeline.status.tsv')
+    df_status.sort_index().to_csv(output_status, sep='\t')
+    print(f'{datetime.now()} - STRAT Pipeline - Written {output_status} file')
+
+    if args.metrics:
+        # Stage metrics of all samples, one row per sample and stage
+        paths = {basename(d): join(d, 'pipeline.metrics.tsv') for d in sample_dirs}
+        frames = [pd.read_csv(path, sep='\t').assign(sample=name) for name, path in sorted(paths.items()) if isfile(path)]
+        if frames:
+            output_metrics = join(input_dir, 'pipeline.metrics.tsv')
+            pd.concat(frames, ignore_index=True).to_csv(output_metrics, sep='\t', index=False)
+            print(f'{datetime.now()} - STRAT Pipeline - Written {output_metrics} file')
+
+    if (df_status == 'failed').any().any():
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from os import listdir
+from os.path import isfile, join
+import re
+
+import numpy as np
+import yaml
+
+import common
+from fastq2tsv import read_fastq
+
+
+FASTQ_EXTENSIONS = ('.fastq', '.fastq.gz', '.fq', '.fq.gz')
+
+BATCH_SIZE = 5000
+
+ONE = np.uint64(1)
+
+# Flanks are searched as one 64 bit word per read
+MAX_FLANK = 64
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='STRAT Prepare - Short Tandem Repeat Analysis Tool - collect on-target inserts between fuzzy matched flanks')
+
+    # Define string parameters
+    parser.add_argument('--config', type=str, required=True, help='Path to STRAT config file with prefix, suffix, tolerance and cores (ex. "./config.yaml")')
+    parser.add_argument('--input_path', type=str, required=True, help='Path to directory containing input FASTQ(.GZ) files (ex. "/data/fastqs/")')
+    parser.add_argument('--output_path', type=str, required=True, help='Path to directory to store output files (ex. "/data/outputs/")')
+    parser.add_argument('--cores', type=int, default=None, help='Number of worker processes, defaults to cores from the config file (ex. "4")')
+
+    return parser
+
+
+def load_config(config_path):
+    with open(config_path) as f:
+        return yaml.safe_load(f)
+
+
+def parse_tolerance(tolerance):
+    # Maximum number of edits from a regex style fuzzy constraint (ex. "{e<=5}")
+    match = re.search(r'e\s*(<=|<)\s*(\d+)', tolerance)
+    if not match:
+        raise ValueError(f'Unsupported tolerance {tolerance}, expected ex. "{{e<=5}}"')
+    return int(match.group(2)) - (match.group(1) == '<')
+
+
+def check_flanks(prefix, suffix):
+    for name, flank in [('prefix', prefix), ('suffix', suffix)]:
+        if not 0 < len(flank) <= MAX_FLANK:
+            raise ValueError(f'Unsupported {name} of {len(flank)} nt, expected 1 to {MAX_FLANK} nt')
+
+
+def seed_pieces(pattern, k):
+    # Any match with at most k edits contains one of k+1 pattern pieces exactly
+    step = len(pattern) / (k + 1)
+    return [pattern[round(i * step):round((i + 1) * step)] for i in range(k + 1)]
+
+
+def has_seed(seq, pieces):
+    return any(piece in seq for piece in pieces)
+
+
+def peq_table(pattern):
+    peq = np.zeros(256, dtype=np.uint64)
+    for i, n in enumerate(pattern):
+        peq[ord(n)] |= ONE << np.uint64(i)
+    return peq
+
+
+def myers_search(seqs, pattern, offsets, k):
+    # Bit-parallel (Myers) approximate search of pattern in every sequence at
+    # once, one text column per step over all reads still long enough. Matches
+    # may not start before offsets. Returns the lowest edit distance and the
+    # end position reaching it - on ties the later end within k positions,
+    # the longer match a regex BESTMATCH search picks.
+    m = len(pattern)
+    mask = np.uint64((1 << m) - 1)
+    high = ONE << np.uint64(m - 1)
+    peq = peq_table(pattern)
+
+    lens = np.array([len(s) for s in seqs], dtype=np.int64)
+    order = np.argsort(-lens, kind='stable')
+    lens = lens[order]
+    offsets = np.asarray(offsets, dtype=np.int64)[order]
+    codes = common.encode([seqs[i] for i in order], int(lens.max()) if len(lens) else 0)
+
+    pv = np.full(len(seqs), mask, dtype=np.uint64)
+    mv = np.zeros(len(seqs), dtype=np.uint64)
+    score = np.full(len(seqs), m, dtype=np.int64)
+    best = np.full(len(seqs), m + 1, dtype=np.int64)
+    best_end = np.full(len(seqs), -1, dtype=np.int64)
+    active = len(seqs)
+    for j in range(codes.shape[1]):
+        while active and lens[active - 1] <= j:
+            active -= 1
+        a = slice(0, active)
+        eq = peq[codes[a, j]]
+        xv = eq | mv[a]
+        xh = (((eq & pv[a]) + pv[a]) ^ pv[a]) | eq
+        ph = mv[a] | (~(xh | pv[a]) & mask)
+        mh = pv[a] & xh
+        score[a] += (ph & high) != 0
+        score[a] -= (mh & high) != 0
+        ph = (ph << ONE) & mask
+        mh = (mh << ONE) & mask
+        pv[a] = mh | (~(xv | ph) & mask)
+        mv[a] = ph & xv
+
+        before = offsets[a] > j
+        if before.any():
+            pv[a][before] = mask
+            mv[a][before] = 0
+            score[a][before] = m
+        better = ~before & ((score[a] < best[a]) | ((score[a] == best[a]) & (j - best_end[a] <= k)))
+        best[a][better] = score[a][better]
+        best_end[a][better] = j
+
+    result_best = np.empty_like(best)
+    result_end = np.empty_like(best_end)
+    result_best[order] = best
+    result_end[order] = best_end
+    return result_best, result_end
+
+
+def match_starts(seqs, ends, pattern, k):
+    # Start of the best alignment of pattern ending at each end position,
+    # from an edit distance table over the reversed windows of all reads. On
+    # ties the earlier start, the longer match.
+    m = len(pattern)
+    width = m + k
+    windows = [seq[max(0, end - width + 1):end + 1][::-1] for seq, end in zip(seqs, ends)]
+    lens = np.array([len(w) for w in windows], dtype=np.int64)
+    codes = common.encode(windows, width).astype(np.int64)
+    pattern_rev = [ord(n) for n in reversed(pattern)]
+
+    steps = np.arange(width + 1)
+    dist = np.tile(steps, (len(seqs), 1))
+    for i in range(1, m + 1):
+        cost = (codes != pattern_rev[i - 1]).astype(np.int64)
+        tmp = np.empty_like(dist)
+        tmp[:, 0] = i
+        tmp[:, 1:] = np.minimum(dist[:, :-1] + cost, dist[:, 1:] + 1)
+        dist = np.minimum.accumulate(tmp - steps, axis=1) + steps
+    dist[steps[None, :] > lens[:, None]] = np.iinfo(np.int64).max
+    spans = width - dist[:, ::-1].argmin(axis=1)
+    return np.asarray(ends) - spans + 1
+
+
+def find_flanks(seqs, prefix, suffix, k):
+    # Best prefix match followed by the best suffix match after it, for every
+    # sequence; missing matches have distance above k
+    n = len(seqs)
+    prefix_dist, prefix_end = myers_search(seqs, prefix, np.zeros(n), k)
+    found = prefix_dist <= k
+    offsets = np.where(found, prefix_end + 1, [len(s) for s in seqs])
+    suffix_dist, suffix_end = myers_search(seqs, suffix, offsets, k)
+    found &= suffix_dist <= k
+
+    idx = np.flatnonzero(found)
+    prefix_start = np.full(n, -1)
+    suffix_start = np.full(n, -1)
+    if len(idx):
+        found_seqs = [seqs[i] for i in idx]
+        prefix_start[idx] = match_starts(found_seqs, prefix_end[idx], prefix, k)
+        suffix_start[idx] = np.maximum(match_starts(found_seqs, suffix_end[idx], suffix, k), prefix_end[idx] + 1)
+    return found, prefix_dist + suffix_dist, prefix_start, prefix_end, suffix_start, suffix_end
+
+
+def prepare_reads(reads, prefix, suffix, k):
+    # Rows of on-target reads in COLUMNS_PREPARED order. Reverse reads carry
+    # the reverse complemented flanks and are kept in read orientation.
+    flanks = {
+        'fwd': (prefix, suffix),
+        'rev': (common.rev_comp(suffix), common.rev_comp(prefix)),
+    }
+    results = {}
+    for direction, (flank_prefix, flank_suffix) in flanks.items():
+        pieces_prefix = seed_pieces(flank_prefix, k)
+        pieces_suffix = seed_pieces(flank_suffix, k)
+        idx = [i for i, (_, seq, _) in enumerate(reads) if has_seed(seq, pieces_prefix) and has_seed(seq, pieces_suffix)]
+        if idx:
+            seqs = [reads[i][1] for i in idx]
+            matches = find_flanks(seqs, flank_prefix, flank_suffix, k)
+            for j, i in enumerate(idx):
+                if matches[0][j]:
+                    results.setdefault(i, []).append((matches[1][j], direction, [m[j] for m in matches[2:]]))
+
+    rows = []
+    for i in sorted(results):
+        # Lowest total distance wins, fwd on ties
+        _, direction, (ps, pe, ss, se) = min(results[i], key=lambda r: r[0])
+        id, seq, qual = reads[i]
+        rows.append([
+            direction, id,
+            seq[ps:pe + 1], seq[pe + 1:ss], seq[ss:se + 1],
+            qual[ps:pe + 1], qual[pe + 1:ss], qual[ss:se + 1],
+        ])
+    return rows
+
+
+def fastq_stem(fastq_name):
+    # Name without any of FASTQ_EXTENSIONS, so .fq and .gz inputs are written
+    # as .fastq.ontarget.tsv like the rest
+    for extension in sorted(FASTQ_EXTENSIONS, key=len, reverse=True):
+        if fastq_name.endswith(extension):
+            return fastq_name[:-len(extension)]
+    return fastq_name
+
+
+def ordered_map(executor, func, items, window, *args):
+    # executor.map with at most window batches in flight, results in input order
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def batches(reads, batch_size=BATCH_SIZE):
+    reads = iter(reads)
+    while True:
+        batch = list(islice(reads, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def prepare_fastq(fastq_path, output_path, prefix, suffix, k, cores):
+    reads = 0
+    ontarget = 0
+    with open(output_path, 'wt') as o, ProcessPoolExecutor(cores) as executor:
+        for rows, size in ordered_map(executor, prepare_batch, batches(read_fastq(fastq_path)), 2 * cores, prefix, suffix, k):
+            reads += size
+            ontarget += len(rows)
+            o.writelines('\t'.join(row) + '\n' for row in rows)
+    return reads, ontarget
+
+
+def prepare_batch(batch, prefix, suffix, k):
+    return prepare_reads(batch, prefix, suffix, k), len(batch)
+
+
+def main():
+    # Parse the command-line arguments
+    parser = parse_arguments()
+    args = parser.parse_args()
+    config = load_config(args.config)
+    input_path = args.input_path
+    output_path = args.output_path
+
+    prefix = config['prefix']
+    suffix = config['suffix']
+    try:
+        check_flanks(prefix, suffix)
+        k = parse_tolerance(config['tolerance'])
+    except ValueError as e:
+        parser.error(str(e))
+    cores = args.cores or config['cores']
+
+    # Log provided parameters
+    print(f'prefix: {prefix}')
+    print(f'suffix: {suffix}')
+    print(f'tolerance: {config["tolerance"]} ({k} edits)')
+    print(f'cores: {cores}')
+    print(f'input_path: {input_path}')
+    print(f'output_path: {output_path}')
+
+    print(f'{datetime.now()} - STRAT Prepare - Start')
+
+    fastq_names = sorted(f for f in listdir(input_path) if f.endswith(FASTQ_EXTENSIONS) and isfile(join(input_path, f)))
+    for fastq_name in fastq_names:
+        output_ontarget = join(output_path, f'{fastq_stem(fastq_name)}.fastq.ontarget.tsv')
+        reads, ontarget = prepare_fastq(join(input_path, fastq_name), output_ontarget, prefix, suffix, k, cores)
+        print(f'{datetime.now()} - STRAT Prepare - Written {ontarget} of {reads} reads to {output_ontarget}')
+
+    print(f'{datetime.now()} - STRAT Prepare - End')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,19 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from csv import QUOTE_NONE
 from datetime import datetime
-import matplotlib.pyplot as plt
-import matplotlib.ticker as plticker
+import io
+from os import makedirs
+from os.path import getsize, isfile, join
+import shutil
 import numpy as np
 import pandas as pd
-from PIL import Image, ImageDraw
-import seaborn as sns
-from string2string.alignment import NeedlemanWunsch
 
+import common
+import metrics
 
-DIRECTIONS = ['fwd', 'rev']
 
-COMPLEMENT = {
-    'A': 'T',
-    'C': 'G',
-    'G': 'C',
-    'T': 'A'
-}
+DIRECTIONS = ['fwd', 'rev']
 
 COLUMNS = [
     'direction',
@@ -30,6 +26,12 @@ COLUMNS = [
     'suffix_flank_q',
 ]
 
+COLUMNS_QUAL = [
+    'prefix_flank_q',
+    'ins_q',
+    'suffix_flank_q',
+]
+
 COLUMNS_SEQ = [
     'prefix_flank',
     'ins',
@@ -44,15 +46,37 @@ COLUMNS_LEN_EXT = ['len_ins_ext']
 COLUMNS_SEQ_ALN = ['ins_aln', 'ins_ext_aln']
 COLUMNS_LEN_ALN = ['len_ins_aln', 'len_ins_ext_aln']
 
-MATCH_WEIGHT = 10
-MISMATCH_WEIGHT = -8
-GAP_WEIGHT = -9
-NW = NeedlemanWunsch(
-    match_weight=MATCH_WEIGHT,
-    mismatch_weight=MISMATCH_WEIGHT,
-    gap_weight=GAP_WEIGHT,
-    gap_char=''
-)
+CONSENSUS = [
+    ('ins', 'len_ins', '', 'consensus inserts'),
+    ('ins_aln', 'len_ins_aln', '.aln', 'aligned consensus inserts'),
+    ('ins_ext', 'len_ins_ext', '.ext', 'extended consensus inserts'),
+    ('ins_ext_aln', 'len_ins_ext_aln', '.ext.aln', 'extended aligned consensus inserts'),
+]
+
+NOT_SEEN = np.iinfo(np.int64).max
+
+# Rows per chunk counting consensus groups of the processed table when the
+# inserts were processed in shards without --chunksize
+CONSENSUS_CHUNKSIZE = 100000
+
+# Motif fits of unique sequences keyed by (sequence, motif), shared by all align calls
+FIT_CACHE = {}
+
+# Keys of FIT_CACHE fitted or reused in this run, always kept in a persistent cache
+FIT_CACHE_USED = set()
+
+# Fits from earlier runs kept in a persistent cache besides those used in this run
+FIT_CACHE_SIZE = 100000
+
+# Repeat encodings of unique sequences keyed by (sequence, motif)
+REPEAT_CACHE = {}
+
+# Fragments between motifs that are not a multiple of the motif are either
+# padded with I or aligned to the nearest whole number of motifs
+FIT_MODES = ['pad', 'align']
+
+# Alignments of fragments keyed by (fragment, motif)
+FRAGMENT_CACHE = {}
 
 COLORS = {
     'A': '#3DA853',  # green
@@ -72,21 +96,181 @@ def parse_arguments():
     parser.add_argument('--threshold', type=int, required=True, help='Minimum number of inserts of each size (ex. "100")')
     parser.add_argument('--input_path', type=str, required=True, help='Path to TSV file containing output of STRAT Prepare (ex. "/data/fastqs/")')
     parser.add_argument('--output_path', type=str, required=True, help='Path to directory to store output files (ex. "/data/outputs/")')
+    parser.add_argument('--chunksize', type=int, default=None, help='Process inserts in chunks of this many rows to bound memory usage (ex. "100000")')
+    parser.add_argument('--output_format', type=str, default='tsv', choices=['tsv', 'parquet'], help='Format of the processed inserts table (ex. "parquet")')
+    parser.add_argument('--fit_cache', type=str, default=None, help='Path to TSV file with motif fits reused and updated across runs (ex. "/data/outputs/fit_cache.tsv")')
+    parser.add_argument('--fit_cache_size', type=int, default=FIT_CACHE_SIZE, help='Number of fits from earlier runs kept in the fit cache besides those used in this run (ex. "100000")')
+    parser.add_argument('--fit_mode', type=str, default='pad', choices=FIT_MODES, help='Fit fragments between motifs by padding them with I or by banded alignment to whole motifs (ex. "align")')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes fitting shards of the inserts, the outputs are the same as with one (ex. "8")')
+    parser.add_argument('--metrics', type=str, default=None, help='Path to JSON or TSV file with wall time, CPU time, peak memory and rows of every stage (ex. "/data/outputs/process.metrics.tsv")')
+    parser.add_argument('--profile', type=str, default=None, help='Path to cProfile stats of the whole run (ex. "/data/outputs/process.prof")')
     
     return parser
 
 
-def rev_comp(seq, comps):
-    return ''.join(comps.get(n, n) for n in reversed(seq))
+def load(input_path, columns, chunksize=None, usecols=None):
+    # Compact read table - quality strings dropped unless asked for, direction
+    # categorical, sequences Arrow-backed and empty inserts kept as empty strings
+    usecols = usecols or [column for column in columns if column not in COLUMNS_QUAL]
+    string = common.string_dtype()
+    dtype = {column: string for column in usecols}
+    dtype['direction'] = common.DIRECTION_DTYPE
+    return pd.read_csv(input_path, sep='\t', header=None, names=columns, usecols=usecols, dtype=dtype, keep_default_na=False, quoting=QUOTE_NONE, chunksize=chunksize)
+
 
+def process(df, motif_prim, fit_mode='pad'):
+    # Extend on-target inserts
+    with metrics.stage('extend', len(df)):
+        df['ins_ext'] = extend_ins_batch(df, MOTIFS)
+    extended = sum(df['ins'] != df['ins_ext'])
+    print(f'{datetime.now()} - STRAT Process - Extended {extended} inserts')
 
-def load(input_path, columns):
-    df = pd.read_csv(input_path, sep='\t', header=None, dtype=str, quoting=QUOTE_NONE)
-    df.columns = columns
+    # Orient on-target and extended on-target inserts
+    with metrics.stage('orient', len(df)):
+        df = common.orient(df, ['ins', 'ins_ext'])
+    oriented = sum(df['direction'] == 'rev')
+    print(f'{datetime.now()} - STRAT Process - Oriented {oriented} inserts and extended inserts')
+
+    # Calculate lengths of inserts
+    with metrics.stage('lengths', len(df)):
+        df = lengths(df, COLUMNS_SEQ + COLUMNS_SEQ_EXT, COLUMNS_LEN + COLUMNS_LEN_EXT)
+    print(f'{datetime.now()} - STRAT Process - Calculated lengths of inserts')
+
+    # Align on-target inserts
+    with metrics.stage('align', len(df)):
+        df['ins_aln'] = align(df, 'ins', 'len_ins', motif_prim, fit_mode)
+    aligned = sum(df['ins'] != df['ins_aln'])
+    print(f'{datetime.now()} - STRAT Process - Aligned {aligned} inserts')
+
+    # Align extedned on-target inserts
+    with metrics.stage('align_ext', len(df)):
+        df['ins_ext_aln'] = align(df, 'ins_ext', 'len_ins_ext', motif_prim, fit_mode)
+    aligned = sum(df['ins_ext'] != df['ins_ext_aln'])
+    print(f'{datetime.now()} - STRAT Process - Aligned {aligned} extended inserts')
+
+    # Calculate lengths of aligned inserts
+    with metrics.stage('lengths_aln', len(df)):
+        df = lengths(df, COLUMNS_SEQ_ALN, COLUMNS_LEN_ALN)
+    print(f'{datetime.now()} - STRAT Process - Calculated lengths of inserts')
+
+    # Encode repeat structure of extended on-target inserts
+    with metrics.stage('repeats', len(df)):
+        df['ins_ext_repeats'] = encode_repeats(df, 'ins_ext', motif_prim)
+    print(f'{datetime.now()} - STRAT Process - Encoded repeats of extended inserts')
 
     return df
 
 
+def process_chunked(chunks, output_processed, motif_prim, keep_cache=False, fit_mode='pad'):
+    # Append each processed chunk to the output file and keep only the
+    # per-length read counts and the columns needed for the histogram.
+    # Fits are cached per chunk unless they are kept for a persistent cache,
+    # fragment alignments and repeat encodings always per chunk.
+    length_counts = {column_len: pd.Series(dtype=int) for _, column_len, _, _ in CONSENSUS}
+    histogram = []
+    rows = 0
+    with common.table_writer(output_processed) as write:
+        for df in metrics.iterate('load', chunks):
+            rows += len(df)
+            print(f'{datetime.now()} - STRAT Process - Loaded {rows} rows')
+            if not keep_cache:
+                FIT_CACHE.clear()
+                FIT_CACHE_USED.clear()
+            FRAGMENT_CACHE.clear()
+            REPEAT_CACHE.clear()
+            df = process(df, motif_prim, fit_mode)
+            with metrics.stage('write', len(df)):
+                write(df[common.COLUMNS_PROCESSED])
+
+            for column_seq, column_len, _, _ in CONSENSUS:
+                counts = df.groupby(column_len)[column_seq].count()
+                length_counts[column_len] = length_counts[column_len].add(counts, fill_value=0).astype(int)
+            histogram.append(df[['direction', 'len_ins_ext_aln']])
+
+    return length_counts, pd.concat(histogram, ignore_index=True)
+
+
+def shard_ranges(input_path, shards):
+    # Byte ranges of about equal size, each starting at the start of a line
+    size = getsize(input_path)
+    bounds = [0]
+    with open(input_path, 'rb') as f:
+        for i in range(1, shards):
+            f.seek(max(size * i // shards, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def process_shard(input_path, start, end, shard_path, motif_prim, motif_scnd, chunksize, fit_cache, fit_mode='pad'):
+    # Worker processing its own byte range of the inserts, only per-length
+    # counts, histogram columns, new fits and stage metrics are sent back
+    set_motifs(motif_prim, motif_scnd)
+    FIT_CACHE.clear()
+    FIT_CACHE_USED.clear()
+    FRAGMENT_CACHE.clear()
+    REPEAT_CACHE.clear()
+    metrics.STAGES.clear()
+    if fit_cache and isfile(fit_cache):
+        load_fit_cache(fit_cache)
+    with open(input_path, 'rb') as f:
+        f.seek(start)
+        buffer = io.BytesIO(f.read(end - start))
+    chunks = load(buffer, COLUMNS, chunksize) if chunksize else [load(buffer, COLUMNS)]
+    length_counts, histogram = process_chunked(chunks, shard_path, motif_prim, bool(fit_cache) or not chunksize, fit_mode)
+    fits = {key: FIT_CACHE[key] for key in FIT_CACHE_USED} if fit_cache else {}
+    return length_counts, histogram, fits, metrics.STAGES
+
+
+def process_sharded(input_path, output_processed, motif_prim, motif_scnd, chunksize, fit_cache, workers, fit_mode='pad'):
+    # Shards processed in parallel and concatenated in input order, giving the
+    # same tables as processing all inserts in one process
+    shard_dir = f'{output_processed}.shards'
+    makedirs(shard_dir, exist_ok=True)
+    ranges = shard_ranges(input_path, workers)
+    extension = output_processed.split('.')[-1]
+    shard_paths = [join(shard_dir, f'{i}.{extension}') for i in range(len(ranges))]
+    length_counts = {column_len: pd.Series(dtype=int) for _, column_len, _, _ in CONSENSUS}
+    histogram = []
+    try:
+        with ProcessPoolExecutor(min(workers, len(ranges))) as executor:
+            futures = [
+                executor.submit(process_shard, input_path, start, end, shard_path, motif_prim, motif_scnd, chunksize, fit_cache, fit_mode)
+                for (start, end), shard_path in zip(ranges, shard_paths)
+            ]
+            for future in futures:
+                counts, shard_histogram, fits, stages = future.result()
+                for column_len in length_counts:
+                    length_counts[column_len] = length_counts[column_len].add(counts[column_len], fill_value=0).astype(int)
+                histogram.append(shard_histogram)
+                FIT_CACHE.update(fits)
+                FIT_CACHE_USED.update(fits)
+                metrics.STAGES.extend(stages)
+        with metrics.stage('concat', sum(len(h) for h in histogram)):
+            common.concat_tables(shard_paths, output_processed)
+    finally:
+        shutil.rmtree(shard_dir)
+    return length_counts, pd.concat(histogram, ignore_index=True)
+
+
+def set_motifs(motif_prim, motif_scnd):
+    global MOTIFS
+    MOTIFS = {
+        'fwd': [
+            motif_prim,
+            motif_scnd
+            ],
+        'rev': [
+            common.rev_comp(motif_scnd),
+            common.rev_comp(motif_prim)
+            ]
+    }
+    return MOTIFS
+
+
 def extend_ins(row):
     prefix = row['prefix_flank']
     ins = row['ins']
@@ -113,34 +297,67 @@ def extend_ins(row):
     return ins
 
 
-def orient_ins(row, column_seq):
-    seq = row[column_seq]
-    seq = rev_comp(seq, COMPLEMENT) if row['direction'] == 'rev' else seq
-    return seq
+def extend_ins_batch(df, motifs):
+    # Same rules as extend_ins, evaluated for all reads of a direction at once
+    # by testing every motif overlap with vectorized startswith/endswith
+    result = df['ins'].copy()
+    for direction, (motif_prefix, motif_suffix) in motifs.items():
+        cond = df['direction'] == direction
+        if not cond.any():
+            continue
+        prefix = df.loc[cond, 'prefix_flank']
+        ins = df.loc[cond, 'ins']
+        suffix = df.loc[cond, 'suffix_flank']
+
+        # i in (window-1)..1, first (longest) overlap wins
+        target = 2 * motif_prefix
+        window = len(target)
+        head = pd.Series('', index=ins.index, dtype=object)
+        pending = pd.Series(True, index=ins.index)
+        for s in range(window - 1):
+            i = window - 1 - s
+            hit = pending & prefix.str.endswith(target[:i]) & ins.str.startswith(target[i:])
+            head[hit] = target[:i]
+            pending &= ~hit
+        ins = head + ins
+
+        # i in 1..(window-1), first (shortest) overlap wins
+        target = 2 * motif_suffix
+        window = len(target)
+        tail = pd.Series('', index=ins.index, dtype=object)
+        pending = pd.Series(True, index=ins.index)
+        for s in range(window - 1):
+            i = s + 1
+            hit = pending & ins.str.endswith(target[:i]) & suffix.str.startswith(target[i:])
+            tail[hit] = target[i:]
+            pending &= ~hit
+        result[cond] = ins + tail
+
+    return result
 
 
 def lengths(df, columns_seq, columns_len):
     for s, l in zip(columns_seq, columns_len):
-        df[l] = df[s].str.len()
+        df[l] = df[s].str.len().astype(np.int32)
     return df
 
 
-def group(df, column_seq, column_len, cutoff=120000):
-    dfg = df.groupby([column_seq, column_len])['id'].count().reset_index()
-    dfg.columns = [column_seq, column_len, 'count']
-    cond = dfg[column_len] <= cutoff
-    dfg = dfg[cond]
-    dfg = dfg.sort_values([column_len, column_seq])
-    return dfg
+def align_fragment(t, motif, cache=FRAGMENT_CACHE):
+    # Fragment aligned to the nearest whole number of motifs - bases inserted
+    # relative to the ideal repeat dropped, deleted bases filled with I
+    key = (t, motif)
+    if key not in cache:
+        source = int(np.round(len(t) / len(motif))) * motif
+        aligned_source, aligned_target = common.banded_alignment(source, t)
+        cache[key] = ''.join('I' if b == '-' else b for a, b in zip(aligned_source, aligned_target) if a != '-')
+    return cache[key]
 
 
-def fit_target(t, len_motif, nw=NW):
+def fit_target(t, motif, fit_mode='pad'):
+    len_motif = len(motif)
     if t is not None and len(t) > 0 and len(t) % len_motif != 0:
-        # source = int(np.round((len(t) / 3))) * motif
-        # aligned_source, aligned_target = nw.get_alignment(source, t, return_score_matrix=False)
-        # aligned_source = aligned_source.split(' | ')
-        # aligned_target = aligned_target.split(' | ')
-        # return ''.join(t for s, t in zip(aligned_source, aligned_target) if s != ' ')
+        if fit_mode == 'align':
+            return align_fragment(t, motif)
 
         len_fill = len_motif - len(t) % len_motif
         fill = ''.join('I' for _ in range(len_fill))
@@ -149,21 +366,62 @@ def fit_target(t, len_motif, nw=NW):
     return t
 
 
-def fit(row, column_seq, motif):
-    target = row[column_seq]
+def fit_seq(target, motif, fit_mode='pad'):
     targets = target.split(motif)
     if targets:
-        return motif.join(fit_target(t, len(motif)) for t in targets)
+        return motif.join(fit_target(t, motif, fit_mode) for t in targets)
     else:
         return target
 
 
-def align(df, column_seq, column_len, motif):
-    column_seq_aln = column_seq+'_aln'
-    dfg = group(df, column_seq, column_len, 120000)
-    dfg[column_seq_aln] = dfg.apply(lambda x: fit(x, column_seq, motif), axis=1)
-    alns = dict(zip(dfg[column_seq], dfg[column_seq_aln]))
-    return df.apply(lambda x: alns.get(x[column_seq], x[column_seq]), axis=1)
+def align(df, column_seq, column_len, motif, fit_mode='pad', cutoff=120000, cache=FIT_CACHE, used=FIT_CACHE_USED):
+    # Fit each unique sequence once, reusing fits cached by (sequence, motif,
+    # fit mode) from earlier calls, and map the fits back to the reads
+    seqs = df[column_seq]
+    hits = 0
+    misses = 0
+    alns = {}
+    for seq in seqs[df[column_len] <= cutoff].dropna().unique():
+        key = (seq, motif, fit_mode)
+        if key in cache:
+            hits += 1
+        else:
+            cache[key] = fit_seq(seq, motif, fit_mode)
+            misses += 1
+        used.add(key)
+        alns[seq] = cache[key]
+    print(f'{datetime.now()} - STRAT Process - Fit cache {hits} hits, {misses} misses for {column_seq}')
+    return seqs.map(alns).fillna(seqs)
+
+
+def encode_repeats(df, column_seq, motif, cache=REPEAT_CACHE):
+    # Tokenize each unique sequence once and map the encodings back to the reads
+    encodings = {}
+    for seq in df[column_seq].dropna().unique():
+        key = (seq, motif)
+        if key not in cache:
+            cache[key] = common.repeat_tokens(seq, motif)
+        encodings[seq] = cache[key]
+    return df[column_seq].map(encodings)
+
+
+def load_fit_cache(input_path, cache=FIT_CACHE):
+    # Caches written before fit modes hold padded fits only
+    df = pd.read_csv(input_path, sep='\t', dtype=str, keep_default_na=False, quoting=QUOTE_NONE)
+    if 'fit_mode' not in df.columns:
+        df['fit_mode'] = 'pad'
+    cache.update(zip(zip(df['seq'], df['motif'], df['fit_mode']), df['aln']))
+    return cache
+
+
+def save_fit_cache(output_path, cache=FIT_CACHE, used=FIT_CACHE_USED, size=FIT_CACHE_SIZE):
+    # Fits used in this run and the last size others, oldest first, so the
+    # cache does not grow with every run
+    others = [key for key in cache if key not in used]
+    keys = others[max(0, len(others) - size):] + [key for key in cache if key in used]
+    df = pd.DataFrame([(*key, cache[key]) for key in keys], columns=['seq', 'motif', 'fit_mode', 'aln'])
+    df.to_csv(output_path, sep='\t', index=False, quoting=QUOTE_NONE)
+    return len(df)
 
 
 def get_abundant_lengths(df, column_seq, column_len, threshold):
@@ -174,6 +432,10 @@ def get_abundant_lengths(df, column_seq, column_len, threshold):
     return set(dfg[column_len])
 
 
+def get_abundant_lengths_from_counts(length_counts, threshold):
+    return set(length_counts[length_counts > threshold].index)
+
+
 def consensus_string(strings):
     if not strings or not all(len(strings[0]) == len(s) for s in strings):
         raise ValueError("Input strings must be non-empty and of equal length")
@@ -195,21 +457,112 @@ def consensus_string(strings):
     return consensus
 
 
-def get_consensus_strings(df, abundant_lengths, column_seq, column_len, directions):
+def position_counts(strings, offset=0):
+    # Encode equal-length strings as a uint8 matrix and, for each symbol, count it
+    # per position and record the first row it was seen in (shifted by offset)
+    mat = np.frombuffer(''.join(strings).encode('ascii'), dtype=np.uint8).reshape(len(strings), -1)
+    counts = {}
+    for symbol in np.unique(mat):
+        hits = mat == symbol
+        first = np.where(hits.any(axis=0), hits.argmax(axis=0) + offset, NOT_SEEN)
+        counts[chr(symbol)] = (hits.sum(axis=0), first)
+    return counts
+
+
+def merge_position_counts(counts, other):
+    for symbol, (cnt, first) in other.items():
+        if symbol in counts:
+            cnt_acc, first_acc = counts[symbol]
+            counts[symbol] = (cnt_acc + cnt, np.minimum(first_acc, first))
+        else:
+            counts[symbol] = (cnt, first)
+    return counts
+
+
+def consensus_from_counts(counts):
+    # Ties are resolved in favour of the symbol seen first at the position,
+    # the same as consensus_string
+    symbols = sorted(counts)
+    cnt = np.stack([counts[symbol][0] for symbol in symbols])
+    first = np.stack([counts[symbol][1] for symbol in symbols])
+    first = np.where(cnt == cnt.max(axis=0), first, NOT_SEEN)
+    return ''.join(np.array(symbols)[first.argmin(axis=0)])
+
+
+def count_groups(df, column_seq, column_len, lengths=None, offset=0):
+    if lengths is not None:
+        df = df[df[column_len].isin(lengths)]
+    groups = {}
+    for key, strings in df.groupby([column_len, 'direction'], sort=False, observed=True)[column_seq]:
+        groups[key] = (len(strings), position_counts(list(strings), offset))
+    return groups
+
+
+def merge_groups(groups, other):
+    for key, (count, counts) in other.items():
+        if key in groups:
+            count_acc, counts_acc = groups[key]
+            groups[key] = (count_acc + count, merge_position_counts(counts_acc, counts))
+        else:
+            groups[key] = (count, counts)
+    return groups
+
+
+def count_groups_chunked(input_processed, column_seq, column_len, lengths, chunksize):
+    groups = {}
+    offset = 0
+    reader = common.read_table_chunks(
+        input_processed, ['direction', column_len, column_seq], chunksize, dtype={column_seq: str})
+    for df in reader:
+        merge_groups(groups, count_groups(df, column_seq, column_len, lengths, offset))
+        offset += len(df)
+    return groups
+
+
+def consensus_table(groups, abundant_lengths, column_seq, column_len, directions):
     consensi = []
+    counts = []
     for l in sorted(abundant_lengths):
         for direction in directions:
-            cond = df[column_len] == l
-            cond &= df['direction'] == direction
-            strings = list(df[cond][column_seq])
-            if strings:
-                consensi.append([direction, l, len(strings), consensus_string(strings)])
-    
+            if (l, direction) in groups:
+                count, position_cnts = groups[(l, direction)]
+                consensus = consensus_from_counts(position_cnts)
+                consensi.append([direction, l, count, consensus])
+                counts.append((direction, l, len(consensus), position_cnts))
+
     df_consensus = pd.DataFrame(consensi, columns=['direction', column_len, 'count', column_seq])
+
+    # Per-position count matrix of all consensus groups in long format
+    sizes = [size for _, _, size, _ in counts]
+    symbols = sorted(set(symbol for _, _, _, position_cnts in counts for symbol in position_cnts))
+    df_counts = pd.DataFrame({
+        'direction': np.repeat([direction for direction, _, _, _ in counts], sizes),
+        column_len: np.repeat([l for _, l, _, _ in counts], sizes),
+        'position': np.concatenate([np.arange(size) for size in sizes]) if counts else [],
+    })
+    for symbol in symbols:
+        df_counts[symbol] = np.concatenate([
+            position_cnts[symbol][0] if symbol in position_cnts else np.zeros(size, dtype=int)
+            for _, _, size, position_cnts in counts
+        ])
+    return df_consensus, df_counts
+
+
+def get_consensus(df, abundant_lengths, column_seq, column_len, directions):
+    groups = count_groups(df, column_seq, column_len, abundant_lengths)
+    return consensus_table(groups, abundant_lengths, column_seq, column_len, directions)
+
+
+def get_consensus_strings(df, abundant_lengths, column_seq, column_len, directions):
+    df_consensus, _ = get_consensus(df, abundant_lengths, column_seq, column_len, directions)
     return df_consensus
 
 
 def plot_histogram(df, x, hue, output_histogram):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+    import seaborn as sns
+
     fig, ax = plt.subplots(figsize=(16, 10))
     gfg = sns.histplot(df, x=x, discrete=True, hue=hue)
     # gfg.set_xlim(0, 1000)
@@ -218,6 +571,7 @@ def plot_histogram(df, x, hue, output_histogram):
     gfg.xaxis.set_major_locator(loc)
     gfg.set_xticklabels(gfg.get_xticklabels(), rotation=90)
     fig.savefig(output_histogram)
+    plt.close(fig)
 
 
 def main():
@@ -230,19 +584,15 @@ def main():
     threshold = args.threshold
     input_path = args.input_path
     output_path = args.output_path
+    chunksize = args.chunksize
+    fit_cache = args.fit_cache
+    output_format = args.output_format
+    fit_mode = args.fit_mode
+    workers = args.workers
+    profile = metrics.start_profile(args.profile)
 
     # Generate reverse complement motif
-    global MOTIFS
-    MOTIFS = {
-        'fwd': [
-            motif_prim,
-            motif_scnd
-            ],
-        'rev': [
-            rev_comp(motif_scnd, COMPLEMENT),
-            rev_comp(motif_prim, COMPLEMENT)
-            ]
-    }
+    set_motifs(motif_prim, motif_scnd)
 
     # Log provided parameters
     print(f'motif_prim: {motif_prim}')
@@ -250,89 +600,72 @@ def main():
     print(f'threshold: {threshold}')
     print(f'input_path: {input_path}')
     print(f'output_path: {output_path}')
+    print(f'chunksize: {chunksize}')
+    print(f'fit_cache: {fit_cache}')
+    print(f'fit_cache_size: {args.fit_cache_size}')
+    print(f'output_format: {output_format}')
+    print(f'fit_mode: {fit_mode}')
+    print(f'workers: {workers}')
 
     print(f'{datetime.now()} - STRAT Process - Start')
 
-    # Load on-target inserts
-    df = load(input_path, COLUMNS)
-    print(f'{datetime.now()} - STRAT Process - Loaded {len(df)} rows')
-    
-    # Extend on-target inserts
-    df['ins_ext'] = df.apply(extend_ins, axis=1)
-    extended = sum(df['ins'] != df['ins_ext'])
-    print(f'{datetime.now()} - STRAT Process - Extended {extended} inserts')
-    
-    # Orient on-target inserts
-    df['ins'] = df.apply(lambda x: orient_ins(x, 'ins'), axis=1)
-    oriented = sum(df['direction'] == 'rev')
-    print(f'{datetime.now()} - STRAT Process - Oriented {oriented} inserts')
-
-    # Orient extended on-target inserts
-    df['ins_ext'] = df.apply(lambda x: orient_ins(x, 'ins_ext'), axis=1)
-    oriented = sum(df['direction'] == 'rev')
-    print(f'{datetime.now()} - STRAT Process - Oriented {oriented} extended inserts')
-
-    # Calculate lengths of inserts
-    df = lengths(df, COLUMNS_SEQ + COLUMNS_SEQ_EXT, COLUMNS_LEN + COLUMNS_LEN_EXT)
-    print(f'{datetime.now()} - STRAT Process - Calculated lengths of inserts')
-    print(df)
-    # Align on-target inserts
-    df['ins_aln'] = align(df, 'ins', 'len_ins', motif_prim)
-    aligned = sum(df['ins'] != df['ins_aln'])
-    print(f'{datetime.now()} - STRAT Process - Aligned {aligned} inserts')
-
-    # Align extedned on-target inserts
-    df['ins_ext_aln'] = align(df, 'ins_ext', 'len_ins_ext', motif_prim)
-    aligned = sum(df['ins_ext'] != df['ins_ext_aln'])
-    print(f'{datetime.now()} - STRAT Process - Aligned {aligned} extended inserts')
-
-    # Calculate lengths of aligned inserts
-    df = lengths(df, COLUMNS_SEQ_ALN, COLUMNS_LEN_ALN)
-    print(f'{datetime.now()} - STRAT Process - Calculated lengths of inserts')
+    if fit_cache and isfile(fit_cache):
+        load_fit_cache(fit_cache)
+        print(f'{datetime.now()} - STRAT Process - Loaded {len(FIT_CACHE)} fits from {fit_cache}')
 
     name = '.'.join(input_path.split('/')[-1].split('.')[:-1])
     output_processed = f'{output_path}{name}.processed.tsv'
-    df[[
-        'id', 'direction',
-        'len_ins', 'len_ins_aln', 'len_ins_ext', 'len_ins_ext_aln',
-        'ins', 'ins_aln', 'ins_ext', 'ins_ext_aln',
-        ]].to_csv(output_processed, sep='\t', index=False)
-    print(f'{datetime.now()} - STRAT Process - Written {output_processed} file')
-
-    # Generate consensus strings per insert size
-    abundant_lengths = get_abundant_lengths(df, 'ins', 'len_ins', threshold)
-    dfc = get_consensus_strings(df, abundant_lengths, 'ins', 'len_ins', DIRECTIONS)
-    output_consensus = f'{output_path}{name}.processed.consensus.tsv'
-    dfc.to_csv(output_consensus, index=False, sep='\t')
-    print(f'{datetime.now()} - STRAT Process - Written {len(dfc)} consensus inserts to {output_consensus}')
-
-    # Generate consensus strings per aligned insert size
-    abundant_lengths = get_abundant_lengths(df, 'ins_aln', 'len_ins_aln', threshold)
-    dfc = get_consensus_strings(df, abundant_lengths, 'ins_aln', 'len_ins_aln', DIRECTIONS)
-    output_consensus = f'{output_path}{name}.processed.consensus.aln.tsv'
-    dfc.to_csv(output_consensus, index=False, sep='\t')
-    print(f'{datetime.now()} - STRAT Process - Written {len(dfc)} aligned consensus inserts to {output_consensus}')
-
-    # Generate consensus strings per extended insert size
-    abundant_lengths = get_abundant_lengths(df, 'ins_ext', 'len_ins_ext', threshold)
-    dfc = get_consensus_strings(df, abundant_lengths, 'ins_ext', 'len_ins_ext', DIRECTIONS)
-    output_consensus = f'{output_path}{name}.processed.consensus.ext.tsv'
-    dfc.to_csv(output_consensus, index=False, sep='\t')
-    print(f'{datetime.now()} - STRAT Process - Written {len(dfc)} extended consensus inserts to {output_consensus}')
-
-    # Generate consensus strings per extended aligned insert size
-    abundant_lengths = get_abundant_lengths(df, 'ins_ext_aln', 'len_ins_ext_aln', threshold)
-    dfc = get_consensus_strings(df, abundant_lengths, 'ins_ext_aln', 'len_ins_ext_aln', DIRECTIONS)
-    output_consensus = f'{output_path}{name}.processed.consensus.ext.aln.tsv'
-    dfc.to_csv(output_consensus, index=False, sep='\t')
-    print(f'{datetime.now()} - STRAT Process - Written {len(dfc)} extended aligned consensus inserts to {output_consensus}')
+    if output_format == 'parquet':
+        output_processed = common.columnar_path(output_processed)
+
+    if workers > 1:
+        # Process shards of the inserts in parallel, each one in chunks if asked
+        length_counts, df = process_sharded(input_path, output_processed, motif_prim, motif_scnd, chunksize, fit_cache, workers, fit_mode)
+        print(f'{datetime.now()} - STRAT Process - Written {output_processed} file from {workers} workers')
+    elif chunksize:
+        # Stream inserts in chunks and keep only per-length aggregates in memory
+        length_counts, df = process_chunked(load(input_path, COLUMNS, chunksize), output_processed, motif_prim, bool(fit_cache), fit_mode)
+        print(f'{datetime.now()} - STRAT Process - Written {output_processed} file')
+    else:
+        # Load on-target inserts
+        with metrics.stage('load') as stage:
+            df = load(input_path, COLUMNS)
+            stage['rows_out'] = len(df)
+        print(f'{datetime.now()} - STRAT Process - Loaded {len(df)} rows')
+
+        df = process(df, motif_prim, fit_mode)
+        with metrics.stage('write', len(df)), common.table_writer(output_processed) as write:
+            write(df[common.COLUMNS_PROCESSED])
+        print(f'{datetime.now()} - STRAT Process - Written {output_processed} file')
+
+    if fit_cache:
+        fits = save_fit_cache(fit_cache, size=args.fit_cache_size)
+        print(f'{datetime.now()} - STRAT Process - Written {fits} fits to {fit_cache}')
+
+    # Generate consensus strings per (aligned, extended) insert size
+    for column_seq, column_len, suffix, label in CONSENSUS:
+        with metrics.stage(f'consensus{suffix}', len(df)) as stage:
+            if chunksize or workers > 1:
+                abundant_lengths = get_abundant_lengths_from_counts(length_counts[column_len], threshold)
+                groups = count_groups_chunked(output_processed, column_seq, column_len, abundant_lengths, chunksize or CONSENSUS_CHUNKSIZE)
+            else:
+                abundant_lengths = get_abundant_lengths(df, column_seq, column_len, threshold)
+                groups = count_groups(df, column_seq, column_len, abundant_lengths)
+            dfc, dfcc = consensus_table(groups, abundant_lengths, column_seq, column_len, DIRECTIONS)
+            stage['rows_out'] = len(dfc)
+        output_consensus = f'{output_path}{name}.processed.consensus{suffix}.tsv'
+        dfc.to_csv(output_consensus, index=False, sep='\t')
+        dfcc.to_csv(f'{output_path}{name}.processed.consensus{suffix}.counts.tsv', index=False, sep='\t')
+        print(f'{datetime.now()} - STRAT Process - Written {len(dfc)} {label} to {output_consensus}')
 
     # # Plot histogram
     output_histogram = f'{output_path}/inserts.ontarget.ext.png'
-    plot_histogram(df.sort_values('direction'), 'len_ins_ext_aln', 'direction', output_histogram)
+    with metrics.stage('histogram', len(df)):
+        plot_histogram(df.sort_values('direction'), 'len_ins_ext_aln', 'direction', output_histogram)
     print(f'{datetime.now()} - STRAT Process - Plotted insert length histogram to {output_histogram}')
 
     print(f'{datetime.now()} - STRAT Process - End')
+    metrics.finish('strat_process', args.metrics, profile, args.profile)
 
 
 if __name__ == "__main__":
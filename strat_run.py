@@ -0,0 +1,126 @@
+import argparse
+from datetime import datetime
+from os.path import join
+
+import pandas as pd
+
+import common
+import fastq2tsv
+import metrics
+import plots
+import strat_process
+import summarize
+
+
+EXPORTS = ['processed', 'consensus', 'fastq', 'fastq_ontarget']
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='STRAT Run - process, summarize and plot one sample in memory, without intermediate files')
+
+    # Define string parameters
+    parser.add_argument('--motif_prim', type=str, required=True, help='Primary motif of the repeated block in forward orientation (ex. "CTG")')
+    parser.add_argument('--motif_scnd', type=str, required=True, help='Secondary motif of the repeated block in forward orientation (ex. "CTG")')
+    parser.add_argument('--threshold', type=int, required=True, help='Minimum number of inserts of each size to generate consensus (ex. "100")')
+    parser.add_argument('--limit_nt', type=int, default=plots.LIMIT_NT, help='Longest wild-type insert in nucleotides, longer inserts are expanded (ex. "150")')
+    parser.add_argument('--fit_mode', type=str, default='pad', choices=strat_process.FIT_MODES, help='Fit fragments between motifs by padding them with I or by banded alignment to whole motifs (ex. "align")')
+    parser.add_argument('--input_path', type=str, required=True, help='Path to on-target inserts file (ex. "/data/sample/merged.ontarget.tsv")')
+    parser.add_argument('--fastq_path', type=str, required=True, help='Path to directory containing merged FASTQ(.GZ) files (ex. "/data/sample/")')
+    parser.add_argument('--lambda_alignment_summary', type=str, required=True, help='Path to lambda alignment summary file (ex. "/data/sample/lambda_alignment/lambda_alignment_summary.tsv")')
+    parser.add_argument('--output_path', type=str, required=True, help='Path to directory to store output files (ex. "/data/sample/")')
+    parser.add_argument('--sample_name', type=str, default=None, help='Sample name used in summary tables and plots, defaults to the output directory name (ex. "sample1")')
+    parser.add_argument('--export', type=str, nargs='*', default=['processed', 'consensus'], choices=EXPORTS, help='Intermediate tables written next to the results (ex. "processed consensus fastq fastq_ontarget")')
+    parser.add_argument('--metrics', type=str, default=None, help='Path to JSON or TSV file with wall time, CPU time, peak memory and rows of every stage (ex. "/data/sample/analyze.metrics.tsv")')
+    parser.add_argument('--profile', type=str, default=None, help='Path to cProfile stats of the whole run (ex. "/data/sample/analyze.prof")')
+
+    return parser
+
+
+def load_reads(fastq_path):
+    # Reads of all merged FASTQ files as fastq2tsv writes them to fastq.tsv
+    reads = [(seq, id) for path in fastq2tsv.list_fastqs(fastq_path) for id, seq, _ in fastq2tsv.read_fastq(path)]
+    return pd.DataFrame(reads, columns=['seq', 'id'], dtype=str)
+
+
+def run_sample(df_ontarget, df_fastq, lambda_reads, non_lambda_reads, output_path, motif_prim, motif_scnd, threshold, sample_name, exports=('processed', 'consensus'), limit_nt=plots.LIMIT_NT, fit_mode='pad'):
+    # Extension, orientation, alignment, consensus, summary and plots over one
+    # in-memory dataset, writing the same files as the separate scripts. The
+    # processed, consensus and merged FASTQ tables are written only when exported.
+    name = 'merged.ontarget'
+    strat_process.set_motifs(motif_prim, motif_scnd)
+
+    # Processing orients inserts in place, plots need them as read
+    df = strat_process.process(df_ontarget.copy(), motif_prim, fit_mode)
+    if 'processed' in exports:
+        output_processed = join(output_path, f'{name}.processed.tsv')
+        with metrics.stage('write', len(df)), common.table_writer(output_processed) as write:
+            write(df[common.COLUMNS_PROCESSED])
+        print(f'{datetime.now()} - STRAT Run - Written {output_processed} file')
+
+    # Generate consensus strings per (aligned, extended) insert size
+    consensus = {}
+    for column_seq, column_len, suffix, label in strat_process.CONSENSUS:
+        with metrics.stage(f'consensus{suffix}', len(df)) as stage:
+            abundant_lengths = strat_process.get_abundant_lengths(df, column_seq, column_len, threshold)
+            groups = strat_process.count_groups(df, column_seq, column_len, abundant_lengths)
+            dfc, dfcc = strat_process.consensus_table(groups, abundant_lengths, column_seq, column_len, strat_process.DIRECTIONS)
+            stage['rows_out'] = len(dfc)
+        consensus[suffix] = dfc
+        if 'consensus' in exports:
+            output_consensus = join(output_path, f'{name}.processed.consensus{suffix}.tsv')
+            dfc.to_csv(output_consensus, index=False, sep='\t')
+            dfcc.to_csv(join(output_path, f'{name}.processed.consensus{suffix}.counts.tsv'), index=False, sep='\t')
+            print(f'{datetime.now()} - STRAT Run - Written {len(dfc)} {label} to {output_consensus}')
+
+    output_histogram = join(output_path, 'inserts.ontarget.ext.png')
+    with metrics.stage('histogram', len(df)):
+        strat_process.plot_histogram(df.sort_values('direction'), 'len_ins_ext_aln', 'direction', output_histogram)
+    print(f'{datetime.now()} - STRAT Run - Plotted insert length histogram to {output_histogram}')
+
+    if 'fastq' in exports:
+        output_fastq = join(output_path, 'fastq.tsv')
+        df_fastq.to_csv(output_fastq, sep='\t', index=False, header=False)
+        print(f'{datetime.now()} - STRAT Run - Written {output_fastq} file')
+
+    output_merged = join(output_path, 'fastq.ontarget.tsv') if 'fastq_ontarget' in exports else None
+    plots.plot_sample(df_fastq, df_ontarget, df, output_path, output_merged, motif_prim, limit_nt)
+    print(f'{datetime.now()} - STRAT Run - Plotted waterfalls and histograms to {output_path}')
+
+    summarize.summarize(df, lambda_reads, non_lambda_reads, sample_name, join(output_path, 'merged'), output_path, limit_nt)
+    print(f'{datetime.now()} - STRAT Run - Written summary of {sample_name}')
+
+    return df, consensus
+
+
+def main():
+    # Parse the command-line arguments
+    args = parse_arguments().parse_args()
+    sample_name = args.sample_name or summarize.get_sample_name(args.output_path)
+    profile = metrics.start_profile(args.profile)
+
+    # Log provided parameters
+    for arg, value in vars(args).items():
+        print(f'{arg}: {value}')
+
+    print(f'{datetime.now()} - STRAT Run - Start')
+
+    with metrics.stage('load') as stage:
+        # Quality strings are only needed for the merged table
+        usecols = strat_process.COLUMNS if 'fastq_ontarget' in args.export else None
+        df_ontarget = strat_process.load(args.input_path, strat_process.COLUMNS, usecols=usecols)
+        stage['rows_out'] = len(df_ontarget)
+    print(f'{datetime.now()} - STRAT Run - Loaded {len(df_ontarget)} on-target rows')
+    with metrics.stage('load_reads') as stage:
+        df_fastq = load_reads(args.fastq_path)
+        stage['rows_out'] = len(df_fastq)
+    print(f'{datetime.now()} - STRAT Run - Loaded {len(df_fastq)} reads')
+    lambda_reads, non_lambda_reads = summarize.load_lambda_counts(args.lambda_alignment_summary)
+
+    run_sample(df_ontarget, df_fastq, lambda_reads, non_lambda_reads, args.output_path, args.motif_prim, args.motif_scnd, args.threshold, sample_name, args.export, args.limit_nt, args.fit_mode)
+
+    print(f'{datetime.now()} - STRAT Run - End')
+    metrics.finish('strat_run', args.metrics, profile, args.profile)
+
+
+if __name__ == "__main__":
+    main()
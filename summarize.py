@@ -1,8 +1,18 @@
 import pandas as pd
 import numpy as np
 import argparse
-import seaborn as sns 
-import matplotlib.pyplot as plt 
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from os.path import abspath, basename, dirname, isfile, join
+
+import common
+import metrics
+
+LIMIT_NT = 150
+
+ALLELES = ['wt', 'exp']
+
+PERCENTILES = [10, 50, 90]
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='FASTQ to TSV file converter - Takes Raw .FASTQ files and makes one .TSV file ')
@@ -10,144 +20,123 @@ def parse_arguments():
     parser.add_argument('--lambda_alignment_summary', type=str, help='Path to the summary.tsv file')
     parser.add_argument('--strat_process_output', type=str, help='Path to another TSV file')
     parser.add_argument('--output_dir_path', type=str, help='Path to output folder')
+    parser.add_argument('--limit_nt', type=int, default=LIMIT_NT, help='Shortest expanded insert in nucleotides, shorter inserts are wild-type (ex. "150")')
+    parser.add_argument('--cohort', type=str, nargs='+', default=None, help='Processed tables of many samples summarized into one cohort table, each in its sample directory (ex. "/data/*/merged.ontarget.processed.tsv")')
+    parser.add_argument('--cohort_output', type=str, default='cohort_output.csv', help='Path to the cohort table (ex. "/data/cohort_output.csv")')
+    parser.add_argument('--workers', type=int, default=1, help='Number of samples summarized in parallel in cohort mode (ex. "8")')
+    parser.add_argument('--metrics', type=str, default=None, help='Path to JSON or TSV file with wall time, CPU time, peak memory and rows of every stage (ex. "/data/outputs/summarize.metrics.tsv")')
+    parser.add_argument('--profile', type=str, default=None, help='Path to cProfile stats of the whole run (ex. "/data/outputs/summarize.prof")')
     
     return parser
 
 # Define functions
-def get_subset(df, condition):
-    return df[condition]
-
-# Main function to encapsulate script logic
-def main(lambda_alignment_summpary, strat_process_output, output_dir_path):
-    # Import data
+def load_lambda_counts(lambda_alignment_summpary):
     # Import lambda-alignment summary
-    print('starting main, line 15, proba.pz')
     df_lambda = pd.read_csv(lambda_alignment_summpary, sep='\t', header=None)
     df_lambda.columns = ['Read_type', 'Count']
     df_lambda.set_index('Read_type', inplace=True)
 
     lambda_reads = int(df_lambda.loc['Aligned', 'Count'])
     non_lambda_reads = int(df_lambda.loc['Unaligned', 'Count'])
+    return lambda_reads, non_lambda_reads
 
-    if lambda_reads == 0 and non_lambda_reads ==0:
-        lambda_sum = -1
-    else:
-        lambda_sum =   lambda_reads + non_lambda_reads  
+
+# Main function to encapsulate script logic
+def main(lambda_alignment_summpary, strat_process_output, output_dir_path, limit_nt=LIMIT_NT):
+    # Import data
+    print('starting main, line 15, proba.pz')
+    lambda_reads, non_lambda_reads = load_lambda_counts(lambda_alignment_summpary)
 
     # Import df TSV file from STRAT process
-    df = pd.read_csv(strat_process_output, sep='\t')
+    with metrics.stage('load') as stage:
+        df = common.load_tsv(strat_process_output, usecols=['direction', 'len_ins_ext_aln'])
+        stage['rows_out'] = len(df)
     #print(df.columns)
 
-    directions = list(set(df['direction'])) 
-    #print(directions)
-    alleles = ['wt', 'exp']
-    mix_combos = ['wt_fwd', 'wt_rev', 'exp_fwd', 'exp_rev']
-
-    # wt and exp conditions
-    wt_cond = df['len_ins_ext_aln'] < 150  #yaml parser
-    exp_cond = df['len_ins_ext_aln'] >= 150 #yaml parser
-
-    fwd_cond = df['direction']== 'fwd'
-    rev_cond = df['direction'] == 'rev'
-
-    # all reads counts
-    directions_reads_counts = []
-    total_reads_count = df.shape[0]
-    directions_reads_counts.append(('total',total_reads_count)) 
-
-    index = 0
-    for cond in [fwd_cond, rev_cond]:
-        subset_df = get_subset(df, cond)
-        directions_reads_counts.append((directions[index], subset_df.shape[0]))
-        index +=1
-    directions_reads_counts    
-
-    # all reads counts, wt plus exp
-    alleles_reads_counts = []
-    index = 0
-    for cond in [wt_cond, exp_cond]:
-        subset_df = get_subset(df, cond)
-        alleles_reads_counts.append((alleles[index], subset_df.shape[0]))
-        index +=1
-    alleles_reads_counts 
-
-    # wt and exp counts, fwd and rev
-    allele_directions_reads_counts = []
-
-    index = 0
-    for cond_allele in [wt_cond, exp_cond]:
-        for cond_direction in [fwd_cond, rev_cond]:
-            subset_df = get_subset(df, cond_allele & cond_direction )
-            allele_directions_reads_counts.append((mix_combos[index], subset_df.shape[0]))
-            index+=1
-    allele_directions_reads_counts
-
-    # 10th, median, 90th percentile for wt and exp
-    percentiles = []
-    index = 0
-    for cond in [wt_cond, exp_cond]:
-        allele = alleles[index]
-        for perc in [10, 50, 90]:
-            subset_df = get_subset(df, cond)
-            p_nth = float(np.percentile(subset_df['len_ins_ext_aln'], perc))
-            percentiles.append((f'{allele}_{perc}', p_nth/3))
-        index+=1
-
-    # return master_dataframe
-    # dodati total reads
     print(strat_process_output)
-    sample_name = strat_process_output.split('/')[2]
+    sample_dir = dirname(abspath(strat_process_output))
+    sample_name = get_sample_name(sample_dir)
+    print(sample_name)
+    summarize(df, lambda_reads, non_lambda_reads, sample_name, join(sample_dir, basename(strat_process_output).split('.')[0]), output_dir_path, limit_nt)
+
+
+def get_sample_name(sample_dir):
+    # Samples are named after their directory, in every mode of STRAT
+    return basename(abspath(sample_dir))
+
+
+def alleles(df, limit_nt=LIMIT_NT):
+    # wt below limit_nt, exp from it on
+    return pd.Series(np.where(df['len_ins_ext_aln'] < limit_nt, 'wt', 'exp'), index=df.index, name='allele')
+
+
+def count_reads(df, limit_nt=LIMIT_NT):
+    # Reads per allele and direction and allele length percentiles from one
+    # grouping of the reads
+    allele = alleles(df, limit_nt)
+    grouped = df['len_ins_ext_aln'].groupby([allele, df['direction']], observed=True)
+    counts = grouped.size()
+    percentiles = df['len_ins_ext_aln'].groupby(allele).quantile([perc / 100 for perc in PERCENTILES])
+    return counts, percentiles
+
+
+def summary_tables(df, lambda_reads, non_lambda_reads, sample_name, limit_nt=LIMIT_NT):
+    if lambda_reads == 0 and non_lambda_reads ==0:
+        lambda_sum = -1
+    else:
+        lambda_sum =   lambda_reads + non_lambda_reads
+
+    counts, percentiles = count_reads(df, limit_nt)
+    direction_counts = counts.groupby(level='direction').sum()
+    allele_counts = counts.groupby(level='allele').sum()
+
+    total = len(df)
+    reads = {
+        'Fwd reads': direction_counts.get('fwd', 0),
+        'Rev reads': direction_counts.get('rev', 0),
+        'Wt reads': allele_counts.get('wt', 0),
+        'Exp reads': allele_counts.get('exp', 0),
+    }
+    for allele in ALLELES:
+        for direction in common.DIRECTIONS:
+            reads[f'{allele.capitalize()}_{direction}'] = counts.get((allele, direction), 0)
+    reads = {key: int(value) for key, value in reads.items()}
+    lens = {
+        f'{allele.capitalize()}_{perc}th': float(percentiles.get((allele, perc / 100), np.nan)) / 3
+        for allele in ALLELES for perc in PERCENTILES
+    }
+
     master_df = {'Sample':sample_name,
                 'Total_reads': lambda_reads+non_lambda_reads,
                 'Lambda_reads':  lambda_reads,
-                'Non-lambda_reads': non_lambda_reads, 
-                'Total on-target reads': directions_reads_counts[0][1], 
-                'Fwd reads': directions_reads_counts[1][1], 
-                'Rev reads': directions_reads_counts[2][1], 
-                'Wt reads':  alleles_reads_counts[0][1], 
-                'Exp reads': alleles_reads_counts[1][1], 
-                'Wt_fwd': allele_directions_reads_counts[0][1],
-                'Wt_rev': allele_directions_reads_counts[1][1],
-                'Exp_fwd': allele_directions_reads_counts[2][1],
-                'Exp_rev': allele_directions_reads_counts[3][1],
-                'Wt_10th': percentiles[0][1],
-                'Wt_50th': percentiles[1][1],
-                'Wt_90th': percentiles[2][1],
-                'Exp_10th': percentiles[3][1],
-                'Exp_50th': percentiles[4][1],
-                'Exp_90th': percentiles[5][1],
+                'Non-lambda_reads': non_lambda_reads,
+                'Total on-target reads': total,
+                **reads,
+                **lens,
                 }
-    master_df = pd.DataFrame(master_df, index=[0])      
-    save_path_csv = f"{strat_process_output.split('.')[0]}_output.csv"
-    master_df.to_csv(save_path_csv, index=False)
-    print('===============')
-# return master_dataframe
-# dodati total reads
-
-    print(strat_process_output.split('/'))
 
     master_df_percents = {'Sample':sample_name,
                 'Total_reads': lambda_reads+non_lambda_reads,
                 'Lambda_reads':  f"{lambda_reads} ({round(lambda_reads/(lambda_sum),2)}%)",
-                'Non-lambda_reads': f"{non_lambda_reads} ({round(non_lambda_reads/(lambda_sum),2)}%)", 
-                'On-target reads': f"{directions_reads_counts[0][1]} (100%) ",
-                'Wt reads':  f"{alleles_reads_counts[0][1]} ({round(alleles_reads_counts[0][1]/(directions_reads_counts[0][1]),2)}%)", 
-                'Exp reads': f"{alleles_reads_counts[1][1]} ({round(alleles_reads_counts[1][1]/(directions_reads_counts[0][1]),2)}%)",  
-                'Wt_fwd': f"{allele_directions_reads_counts[0][1]} ({round(allele_directions_reads_counts[0][1]/(directions_reads_counts[0][1]),2)}%)", 
-                'Wt_rev': f"{allele_directions_reads_counts[1][1]} ({round(allele_directions_reads_counts[1][1]/(directions_reads_counts[0][1]),2)}%)", 
-                'Exp_fwd': f"{allele_directions_reads_counts[2][1]} ({round(allele_directions_reads_counts[2][1]/(directions_reads_counts[0][1]),2)}%)", 
-                'Exp_rev': f"{allele_directions_reads_counts[3][1]} ({round(allele_directions_reads_counts[3][1]/(directions_reads_counts[0][1]),2)}%)", 
-                'Wt_10th': percentiles[0][1],
-                'Wt_50th': percentiles[1][1],
-                'Wt_90th': percentiles[2][1],
-                'Exp_10th': percentiles[3][1],
-                'Exp_50th': percentiles[4][1],
-                'Exp_90th': percentiles[5][1],
+                'Non-lambda_reads': f"{non_lambda_reads} ({round(non_lambda_reads/(lambda_sum),2)}%)",
+                'On-target reads': f"{total} (100%) ",
+                **{key: f"{value} ({round(value/total,2)}%)" for key, value in reads.items() if key not in ['Fwd reads', 'Rev reads']},
+                **lens,
                 }
-    master_df_percents = pd.DataFrame(master_df_percents, index=[0])      
-    #master_df_percents.to_csv(f"{strat_process_output.split('.')[0]}_output_percents.csv", index=False)
+    return pd.DataFrame(master_df, index=[0]), pd.DataFrame(master_df_percents, index=[0])
 
-    save_path_csv = f"{strat_process_output.split('.')[0]}_output_percents.csv"
+
+# Summary tables and density plots of processed reads, written as
+# {output_prefix}_output.csv, {output_prefix}_output_percents.csv and
+# {output_dir_path}/{sample_name}_{allele}.png
+def summarize(df, lambda_reads, non_lambda_reads, sample_name, output_prefix, output_dir_path, limit_nt=LIMIT_NT):
+    with metrics.stage('summary', len(df)):
+        master_df, master_df_percents = summary_tables(df, lambda_reads, non_lambda_reads, sample_name, limit_nt)
+    save_path_csv = f"{output_prefix}_output.csv"
+    master_df.to_csv(save_path_csv, index=False)
+    print('===============')
+
+    save_path_csv = f"{output_prefix}_output_percents.csv"
     print(save_path_csv)
     #master_df.to_csv(f"{strat_process_output.split('.')[0]}_output.csv", index=False
     master_df.to_csv(save_path_csv, index=False)
@@ -155,15 +144,41 @@ def main(lambda_alignment_summpary, strat_process_output, output_dir_path):
 
 
     # Density plot for 'column1'
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     #plt.figure(figsize=(13,8))
-    index = 0
-    for cond in [wt_cond, exp_cond]:
-        allele = alleles[index]
-        subset_df = get_subset(df, cond)
-        plt.figure(figsize=(13,8))
-        sns.kdeplot(subset_df['len_ins_ext_aln']/3, shade=True, linewidth=1.5)    
-        plt.savefig(f'{output_dir_path}/{sample_name}_{allele}.png', dpi=300)    
-        index+=1
+    allele = alleles(df, limit_nt)
+    for name in ALLELES:
+        subset_df = df[allele == name]
+        with metrics.stage('density_plot', len(subset_df)):
+            plt.figure(figsize=(13,8))
+            sns.kdeplot(subset_df['len_ins_ext_aln']/3, shade=True, linewidth=1.5)    
+            plt.savefig(f'{output_dir_path}/{sample_name}_{name}.png', dpi=300)    
+            plt.close()
+
+
+def summarize_sample(processed_path, limit_nt=LIMIT_NT):
+    # Summary row of a sample directory laid out by STRAT Pipeline, without
+    # lambda counts when the sample has no lambda alignment summary
+    sample_dir = dirname(abspath(processed_path))
+    lambda_path = join(sample_dir, 'lambda_alignment', 'lambda_alignment_summary.tsv')
+    lambda_reads, non_lambda_reads = load_lambda_counts(lambda_path) if isfile(lambda_path) else (0, 0)
+    df = common.load_tsv(processed_path, usecols=['direction', 'len_ins_ext_aln'])
+    return summary_tables(df, lambda_reads, non_lambda_reads, get_sample_name(sample_dir), limit_nt)[0]
+
+
+def summarize_cohort(processed_paths, output_path, limit_nt=LIMIT_NT, workers=1):
+    # One summary row per processed table, in the order the tables are given
+    if workers <= 1:
+        rows = [summarize_sample(path, limit_nt) for path in processed_paths]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            rows = list(executor.map(summarize_sample, processed_paths, repeat(limit_nt)))
+    cohort = pd.concat(rows, ignore_index=True)
+    cohort.to_csv(output_path, index=False)
+    return cohort
+
 
    # def plot_waterfall_processed(df, col_len, col_seq, stretch, grid):
    #     width = min(1500, df[col_len].max())
@@ -229,13 +244,20 @@ def main(lambda_alignment_summpary, strat_process_output, output_dir_path):
 #
 
 
-# Parse the command-line arguments
-args = parse_arguments().parse_args()
-lambda_alignment_summary = args.lambda_alignment_summary
-strat_process_output = args.strat_process_output
-output_dir_path = args.output_dir_path
-    
+if __name__ == "__main__":
+    # Parse the command-line arguments
+    args = parse_arguments().parse_args()
+    lambda_alignment_summary = args.lambda_alignment_summary
+    strat_process_output = args.strat_process_output
+    output_dir_path = args.output_dir_path
+    profile = metrics.start_profile(args.profile)
 
-# Call the main function with the provided input files
-main(lambda_alignment_summary, strat_process_output, output_dir_path)
+    if args.cohort:
+        with metrics.stage('cohort', len(args.cohort)):
+            cohort = summarize_cohort(args.cohort, args.cohort_output, args.limit_nt, args.workers)
+        print(f'Written {len(cohort)} samples to {args.cohort_output}')
+    else:
+        # Call the main function with the provided input files
+        main(lambda_alignment_summary, strat_process_output, output_dir_path, args.limit_nt)
+    metrics.finish('summarize', args.metrics, profile, args.profile)
 
@@ -0,0 +1,86 @@
+import random
+
+import pandas as pd
+import pytest
+
+import benchmark
+import common
+import strat_process
+
+
+@pytest.mark.parametrize('seq, motif, expected', [
+    ('CAG' * 85 + 'CCG' + 'CTG' * 3, 'CAG', 'CAG×85 CCG×1 CTG×3'),
+    ('CAGCAGTTCAGCAG', 'CAG', 'CAG×2 TT×1 CAG×2'),
+    ('ACAGCAGA', 'CAG', 'A×1 CAG×2 A×1'),
+    ('CCTGCCTGCAGGCCTG', 'CCTG', 'CCTG×2 CAGG×1 CCTG×1'),
+    ('CA', 'CAG', 'CA×1'),
+    ('', 'CAG', ''),
+])
+def test_repeat_tokens(seq, motif, expected):
+    assert common.repeat_tokens(seq, motif) == expected
+
+
+def test_encode_repeats_maps_encodings_to_reads():
+    df = pd.DataFrame({'ins_ext': ['CAGCAGCTG', None, 'CAGCAGCTG', 'CAG']})
+
+    encodings = strat_process.encode_repeats(df, 'ins_ext', 'CAG', {})
+
+    assert encodings.tolist()[::2] == ['CAG×2 CTG×1', 'CAG×2 CTG×1']
+    assert pd.isna(encodings[1]) and encodings[3] == 'CAG×1'
+
+
+def noisy_fragments(rng, motif, n):
+    # Fragments of a few motifs with substitutions and deletions, not a
+    # multiple of the motif as the ones fit_target aligns
+    fragments = []
+    while len(fragments) < n:
+        t = ''.join(rng.choice('ACGT') if rng.random() < 0.2 else base for base in motif * rng.randint(1, 8))
+        t = ''.join(base for base in t if rng.random() > 0.1)
+        if len(t) % len(motif):
+            fragments.append(t)
+    return fragments
+
+
+@pytest.mark.parametrize('motif', ['CAG', 'CCTG'])
+def test_banded_alignment_matches_string2string(motif):
+    alignment = pytest.importorskip('string2string.alignment')
+    nw = alignment.NeedlemanWunsch(match_weight=common.MATCH_WEIGHT, mismatch_weight=common.MISMATCH_WEIGHT, gap_weight=common.GAP_WEIGHT)
+
+    for t in noisy_fragments(random.Random(0), motif, 200):
+        source = int(round(len(t) / len(motif))) * motif
+        aligned_source, aligned_target = nw.get_alignment(source, t, return_score_matrix=False)
+        assert common.banded_alignment(source, t) == (aligned_source.replace(' | ', ''), aligned_target.replace(' | ', ''))
+        assert strat_process.align_fragment(t, motif, {}) == benchmark.string2string_fit_fragment(t, motif, nw)
+
+
+def prepare_for_plotting_by_position(df, col_seq, col_len, col_cnt, col_cov):
+    # Reference - value counts of the whole table at every position
+    results = []
+    for i in range(df[col_len].max()):
+        row = dict(df[df[col_len] >= i + 1][col_seq].str[i].value_counts())
+        row[col_cnt] = sum(df[col_len] == i + 1)
+        row[col_cov] = sum(df[col_len] >= i + 1)
+        results.append(row)
+    return pd.DataFrame(results).fillna(0).astype(int)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_prepare_for_plotting_matches_value_counts(seed):
+    rng = random.Random(seed)
+    seqs = [''.join(rng.choice('ACGTI') for _ in range(rng.randint(1, 40))) for _ in range(rng.randint(1, 200))]
+    df = pd.DataFrame({'seq': seqs, 'len': [len(s) for s in seqs]})
+
+    result = common.prepare_for_plotting(df, 'seq', 'len', 'cnt', 'cov')
+    expected = prepare_for_plotting_by_position(df, 'seq', 'len', 'cnt', 'cov')
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_pileup_counts_bases_across_batches():
+    seqs = ['CAG', 'CTGA', 'C', 'CAGCA']
+
+    counts = common.pileup(seqs, 5, batch_size=2)
+
+    assert counts[:, ord('C')].tolist() == [4, 0, 0, 1, 0]
+    assert counts[:, ord('A')].tolist() == [0, 2, 0, 1, 1]
+    assert counts.sum() == sum(len(s) for s in seqs)
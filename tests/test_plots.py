@@ -0,0 +1,160 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import common
+import plots
+
+
+PREFIX = 'ATCCCGGGCCCGCGGTACGAAGACG'
+
+SUFFIX = 'GAGACCGTACCGTCGACTGCAGAAT'
+
+
+@pytest.fixture
+def sample():
+    # Reads of both orientations, some without on-target rows and some with
+    # two, listed out of id order
+    rng = random.Random(0)
+    reads = []
+    ontarget = []
+    for i in rng.sample(range(300), 300):
+        ins = 'CAG' * rng.randint(5, 60)
+        seq = PREFIX + ins + SUFFIX
+        direction = 'fwd'
+        if i % 2:
+            seq = common.rev_comp(seq)
+            direction = 'rev'
+        reads.append([seq, f'read{i}'])
+        if i % 7:
+            ontarget += [[direction, f'read{i}', PREFIX, ins, SUFFIX, '', '', '']] * (2 if i % 5 == 0 else 1)
+    df_fastq = pd.DataFrame(reads, columns=['seq', 'id'])
+    df_ontarget = pd.DataFrame(ontarget, columns=common.COLUMNS_PREPARED)
+    return df_fastq, df_ontarget
+
+
+def waterfall_pixels(path):
+    from PIL import Image
+
+    return np.asarray(Image.open(path))
+
+
+def test_waterfall_does_not_depend_on_merged_export(sample, tmp_path, monkeypatch):
+    df_fastq, df_ontarget = sample
+    monkeypatch.setattr(plots, 'plot_processed', lambda *args: None)
+    (tmp_path / 'plain').mkdir()
+    (tmp_path / 'export').mkdir()
+    (tmp_path / 'files').mkdir()
+
+    plots.plot_sample(df_fastq, df_ontarget, None, tmp_path / 'plain', seed=7)
+    plots.plot_sample(df_fastq, df_ontarget, None, tmp_path / 'export', tmp_path / 'export' / 'fastq.ontarget.tsv', seed=7)
+    df_fastq.to_csv(tmp_path / 'fastq.tsv', sep='\t', index=False, header=False)
+    df_ontarget.to_csv(tmp_path / 'merged.ontarget.tsv', sep='\t', index=False, header=False)
+    plt_df = plots.sample_reads_from_files(str(tmp_path / 'fastq.tsv'), str(tmp_path / 'merged.ontarget.tsv'), chunksize=64, seed=7)
+    plots.plot_reads(plt_df, tmp_path / 'files')
+
+    pixels = waterfall_pixels(tmp_path / 'plain' / 'waterfall.png')
+    assert (tmp_path / 'export' / 'fastq.ontarget.tsv').exists()
+    assert np.array_equal(pixels, waterfall_pixels(tmp_path / 'export' / 'waterfall.png'))
+    assert np.array_equal(pixels, waterfall_pixels(tmp_path / 'files' / 'waterfall.png'))
+
+
+def plot_waterfall_by_point(df, col_len, col_seq, output_path):
+    # Reference - one ImageDraw point per base
+    from PIL import Image, ImageDraw
+
+    width = df[col_len].max()
+    image = Image.new('RGB', (width, len(df)), 'grey')
+    draw = ImageDraw.Draw(image)
+    for i, seq in enumerate(df[col_seq]):
+        left = (width - len(seq)) // 2
+        for j, n in enumerate(seq):
+            draw.point([left + j, i], fill=plots.COLORS[n])
+    image.save(output_path)
+
+
+def plot_waterfall_processed_by_line(df, col_len, col_seq, stretch, grid, output_path):
+    # Reference - one ImageDraw line per base and grid line
+    from PIL import Image, ImageDraw
+
+    width = min(1500, df[col_len].max())
+    fwd = df[df['direction'] == 'fwd'].sort_values([col_len, col_seq], ascending=[True, True])
+    rev = df[df['direction'] == 'rev'].sort_values([col_len, col_seq], ascending=[False, False])
+    inss = list(fwd[col_seq]) + [width * 'I'] + list(rev[col_seq])
+
+    width = width * stretch + stretch
+    height = len(inss)
+    image = Image.new('RGB', (width, height), 'grey')
+    draw = ImageDraw.Draw(image)
+    for y, seq in enumerate(inss):
+        for j, n in enumerate(seq):
+            color = 'black' if n == 'CAG'[j % 3] else common.COLORS[n]
+            draw.line([(stretch * (j + 1), y), (stretch * (j + 1), y + 1)], width=stretch, fill=color)
+    for i in range(width):
+        x = stretch * i + stretch // 2
+        for step, color in [(3, '#AAAAAA'), (30, 'white'), (300, 'black')]:
+            if i % step == 0:
+                draw.line([(x, 0), (x, height)], width=grid, fill=color)
+    image.save(output_path)
+
+
+def test_waterfall_matches_point_drawing(tmp_path):
+    rng = random.Random(1)
+    seqs = [''.join(rng.choice(list(plots.COLORS)) for _ in range(rng.randint(1, 80))) for _ in range(120)]
+    df = pd.DataFrame({'plt_seq': seqs, 'len_seq': [len(s) for s in seqs]})
+
+    plots.plot_waterfall(df, 'len_seq', 'plt_seq', tmp_path / 'array.png', batch_size=32)
+    plot_waterfall_by_point(df, 'len_seq', 'plt_seq', tmp_path / 'point.png')
+
+    assert np.array_equal(waterfall_pixels(tmp_path / 'array.png'), waterfall_pixels(tmp_path / 'point.png'))
+
+
+@pytest.mark.parametrize('stretch, grid, max_len', [(15, 2, 60), (7, 1, 60), (2, 1, 1600)])
+def test_waterfall_processed_matches_line_drawing(tmp_path, stretch, grid, max_len):
+    rng = random.Random(stretch)
+    rows = []
+    for _ in range(40):
+        ins = ''.join('CAG'[j % 3] if rng.random() < 0.8 else rng.choice('ACGTI') for j in range(rng.randint(0, max_len)))
+        rows.append([rng.choice(['fwd', 'rev']), ins, len(ins)])
+    df = pd.DataFrame(rows, columns=['direction', 'ins_ext_aln', 'len_ins_ext_aln'])
+
+    plots.plot_waterfall_processed(df, 'len_ins_ext_aln', 'ins_ext_aln', stretch, grid, tmp_path / 'array.png')
+    plot_waterfall_processed_by_line(df, 'len_ins_ext_aln', 'ins_ext_aln', stretch, grid, tmp_path / 'line.png')
+
+    assert np.array_equal(waterfall_pixels(tmp_path / 'array.png'), waterfall_pixels(tmp_path / 'line.png'))
+
+
+def prepare_row_for_waterfall(row):
+    # Reference - masking and recoding one read at a time
+    plt_seq = row['seq']
+    if not pd.isna(row['prefix_flank']):
+        plt_seq = plt_seq.replace(row['prefix_flank'], '0000000000')
+        plt_seq = plt_seq.replace(row['suffix_flank'], '0000000000')
+    for block, code in [('CTGCTG', '666666'), ('CAGCAG', '333333'), ('CTG', '555'), ('CAG', '444')]:
+        plt_seq = plt_seq.replace(block, code)
+    for base in 'ATCG':
+        plt_seq = plt_seq.replace(base, '_')
+    return plt_seq
+
+
+def test_recoded_reads_match_row_recoding(sample):
+    df_fastq, df_ontarget = sample
+    rng = random.Random(2)
+    # Interrupted repeats of both motifs between noisy context
+    df_fastq.loc[::3, 'seq'] = [
+        ''.join(rng.choice(['CAG', 'CTG', 'CA', 'G', 'T', 'CCG']) for _ in range(rng.randint(0, 60)))
+        for _ in range(len(df_fastq.loc[::3]))
+    ]
+    df = pd.merge(df_fastq, df_ontarget, how='outer', on='id')
+
+    expected = df.apply(prepare_row_for_waterfall, axis=1)
+
+    assert plots.prepare_seqs_for_waterfall(df).tolist() == expected.tolist()
+
+
+def test_recoding_follows_motif():
+    df = pd.DataFrame({'seq': ['AACCTGCCTGCAGGTT'], 'prefix_flank': [None], 'suffix_flank': [None]})
+
+    assert plots.prepare_seqs_for_waterfall(df, 'CCTG').tolist() == ['__333333335555__']
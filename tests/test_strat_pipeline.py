@@ -0,0 +1,22 @@
+import pytest
+
+import strat_pipeline
+
+
+WRITTEN = {
+    'plots': ['sample1/waterfall.png', 'sample1.hist.50.png', 'sample1.hist.51.png', 'sample1.wtrf.50.png', 'sample1.wtrf.51.png', 'sample1/fastq.ontarget.tsv'],
+    'summarize': ['sample1/merged_output.csv', 'sample1/merged_output_percents.csv', 'sample1/sample1_wt.png', 'sample1/sample1_exp.png'],
+}
+
+
+@pytest.mark.parametrize('stage', list(WRITTEN))
+def test_outputs_cover_written_files(tmp_path, stage):
+    # Files of another sample next to this one are not outputs of it
+    (tmp_path / 'sample1').mkdir()
+    for path in WRITTEN[stage] + ['sample10.hist.50.png', 'sample2.wtrf.50.png']:
+        (tmp_path / path).write_text(path)
+    outputs = {name: outputs for name, _, _, outputs, _, _ in strat_pipeline.STAGES}[stage]
+
+    found = strat_pipeline.glob_files(str(tmp_path / 'sample1'), outputs)
+
+    assert found == {str(tmp_path / path) for path in WRITTEN[stage]}
@@ -0,0 +1,63 @@
+import pytest
+
+import benchmark
+import strat_prepare
+
+
+PREFIX = 'ATCCCGGGCCCGCGGTACGAAGACG'
+
+SUFFIX = 'GAGACCGTACCGTCGACTGCAGAAT'
+
+TOLERANCE = '{e<=5}'
+
+
+def synthetic(seed, reads=400):
+    data = list(benchmark.synthetic_reads(PREFIX, SUFFIX, 'CAG', reads, benchmark.EXPANSIONS, 0.02, 0.03, 0.1, seed))
+    truth = {row[1]: (row[0], row[3]) for *_, row in data if row}
+    return [(id, seq, qual) for id, seq, qual, _ in data], truth
+
+
+def inserts(rows):
+    return {row[1]: (row[0], row[3]) for row in rows}
+
+
+@pytest.mark.parametrize('seed', [42, 1, 2])
+def test_find_flanks_matches_regex(seed):
+    pytest.importorskip('regex')
+    reads, truth = synthetic(seed)
+
+    found = inserts(strat_prepare.prepare_reads(reads, PREFIX, SUFFIX, strat_prepare.parse_tolerance(TOLERANCE)))
+    expected = inserts(benchmark.regex_prepare_reads(reads, PREFIX, SUFFIX, TOLERANCE))
+
+    # Same on-target reads, the same inserts for nearly all of them and at
+    # least as many of them right
+    assert found.keys() == expected.keys()
+    assert sum(found[id] == expected[id] for id in expected) >= 0.98 * len(expected)
+    assert sum(found.get(id) == t for id, t in truth.items()) >= sum(expected.get(id) == t for id, t in truth.items())
+
+
+def test_find_flanks_prefers_longest_match_on_ties():
+    # A substitution at the inner end of each flank costs as much as leaving
+    # the base out of the match
+    prefix = PREFIX[:-1] + 'T'
+    suffix = 'T' + SUFFIX[1:]
+    seq = 'TTTT' + prefix + 'CAG' * 10 + 'CA' + suffix + 'TTTT'
+
+    found, dist, prefix_start, prefix_end, suffix_start, suffix_end = strat_prepare.find_flanks([seq], PREFIX, SUFFIX, 5)
+
+    assert found[0] and dist[0] == 2
+    assert seq[prefix_start[0]:prefix_end[0] + 1] == prefix
+    assert seq[suffix_start[0]:suffix_end[0] + 1] == suffix
+
+
+def test_flanks_longer_than_a_word_are_rejected():
+    strat_prepare.check_flanks('A' * 64, SUFFIX)
+    with pytest.raises(ValueError):
+        strat_prepare.check_flanks('A' * 80, SUFFIX)
+    with pytest.raises(ValueError):
+        strat_prepare.check_flanks(PREFIX, 'A' * 65)
+
+
+@pytest.mark.parametrize('fastq_name', ['run1.fastq', 'run1.fastq.gz', 'run1.fq', 'run1.fq.gz'])
+def test_fastq_stem(fastq_name):
+    assert strat_prepare.fastq_stem(fastq_name) == 'run1'
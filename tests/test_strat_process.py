@@ -0,0 +1,147 @@
+import filecmp
+from os.path import dirname, join
+import random
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+import benchmark
+import common
+import strat_process
+
+
+def random_seq(rng, motif, max_len):
+    # Repeat of the motif with a few substitutions, cut at a random length
+    seq = [rng.choice('ACGT') if rng.random() < 0.1 else base for base in motif * (max_len // len(motif) + 1)]
+    start = rng.randrange(len(motif))
+    return ''.join(seq[start:start + rng.randrange(max_len + 1)])
+
+
+def reads_table(rows):
+    return pd.DataFrame(rows, columns=['direction', 'prefix_flank', 'ins', 'suffix_flank'], dtype=common.string_dtype())
+
+
+@pytest.mark.parametrize('motif_prim, motif_scnd', [('CAG', 'CAG'), ('CAG', 'CTG'), ('CCTG', 'CAGG')])
+def test_extend_ins_batch_matches_extend_ins(motif_prim, motif_scnd):
+    motifs = strat_process.set_motifs(motif_prim, motif_scnd)
+    rng = random.Random(0)
+    rows = [
+        # Flanks completing a motif on either side
+        ['fwd', 'TTCA', 'GCAGCAG', 'CAGTT'],
+        ['rev', 'TTCT', 'GCTGCTG', 'CTGTT'],
+        # Empty inserts and flanks shorter than a motif
+        ['fwd', '', '', ''],
+        ['rev', 'C', '', 'A'],
+        ['fwd', 'CA', 'GCA', 'G'],
+        ['rev', '', 'CTG', ''],
+    ]
+    for _ in range(500):
+        direction = rng.choice(strat_process.DIRECTIONS)
+        motif_prefix, motif_suffix = motifs[direction]
+        rows.append([direction, random_seq(rng, motif_prefix, 8), random_seq(rng, motif_prefix, 12), random_seq(rng, motif_suffix, 8)])
+    df = reads_table(rows)
+
+    expected = df.apply(strat_process.extend_ins, axis=1)
+    result = strat_process.extend_ins_batch(df, motifs)
+
+    assert result.tolist() == expected.tolist()
+
+
+def consensus_reads(rng):
+    # Reads of a few lengths in both directions, with two-way ties at the
+    # first positions of every group
+    rows = [
+        ['fwd', 'CAG'], ['fwd', 'CTG'], ['rev', 'GTC'], ['rev', 'CAC'],
+        ['fwd', 'CAGCA'], ['fwd', 'TAGCA'], ['rev', 'GACTG'], ['rev', 'TACTG'],
+    ]
+    for _ in range(300):
+        length = rng.choice([3, 5, 6, 9])
+        rows.append([rng.choice(strat_process.DIRECTIONS), ''.join(rng.choice('ACGTI') for _ in range(length))])
+    df = pd.DataFrame(rows, columns=['direction', 'ins'])
+    df['len_ins'] = df['ins'].str.len()
+    return df
+
+
+def expected_consensus(df, lengths):
+    return [
+        [direction, l, len(group), strat_process.consensus_string(list(group['ins']))]
+        for l in sorted(lengths)
+        for direction in strat_process.DIRECTIONS
+        for group in [df[(df['len_ins'] == l) & (df['direction'] == direction)]]
+        if len(group)
+    ]
+
+
+def test_consensus_matches_consensus_string():
+    df = consensus_reads(random.Random(1))
+    lengths = [3, 5, 9]
+
+    df_consensus = strat_process.get_consensus_strings(df, lengths, 'ins', 'len_ins', strat_process.DIRECTIONS)
+
+    assert df_consensus.values.tolist() == expected_consensus(df, lengths)
+
+
+def test_consensus_of_chunks_matches_consensus_string():
+    df = consensus_reads(random.Random(2))
+    lengths = [3, 5, 6, 9]
+
+    groups = {}
+    for offset in range(0, len(df), 50):
+        chunk = df.iloc[offset:offset + 50]
+        strat_process.merge_groups(groups, strat_process.count_groups(chunk, 'ins', 'len_ins', lengths, offset))
+    df_consensus, _ = strat_process.consensus_table(groups, lengths, 'ins', 'len_ins', strat_process.DIRECTIONS)
+
+    assert df_consensus.values.tolist() == expected_consensus(df, lengths)
+
+
+def test_fit_cache_keeps_used_and_most_recent_fits(tmp_path):
+    path = tmp_path / 'fit_cache.tsv'
+    cache = {(f'seq{i}', 'CAG', 'pad'): f'aln{i}' for i in range(6)}
+    used = {('seq0', 'CAG', 'pad'), ('seq3', 'CAG', 'pad')}
+
+    assert strat_process.save_fit_cache(path, cache, used, 2) == 4
+    loaded = strat_process.load_fit_cache(path, {})
+
+    # Used fits are written last, the most recent ones on the next run
+    assert list(loaded) == [('seq4', 'CAG', 'pad'), ('seq5', 'CAG', 'pad'), ('seq0', 'CAG', 'pad'), ('seq3', 'CAG', 'pad')]
+    assert all(loaded[key] == cache[key] for key in loaded)
+
+
+def run_process(input_path, output_path, *options):
+    output_path.mkdir()
+    subprocess.run([
+        sys.executable, strat_process.__file__,
+        '--motif_prim', 'CAG', '--motif_scnd', 'CAG', '--threshold', '2',
+        '--input_path', str(input_path), '--output_path', f'{output_path}/', *options,
+    ], check=True, capture_output=True)
+    return output_path
+
+
+@pytest.fixture(scope='module')
+def single_pass(tmp_path_factory):
+    # On-target inserts of a synthetic sample processed in one pass
+    path = tmp_path_factory.mktemp('sample')
+    benchmark.generate_sample(join(dirname(strat_process.__file__), 'config.yaml'), str(path), 500, benchmark.EXPANSIONS, 0.02, 0.03, 0.1, 0)
+    return path / 'merged.ontarget.tsv', run_process(path / 'merged.ontarget.tsv', path / 'single')
+
+
+def assert_same_outputs(output_path, expected_path):
+    names = sorted(p.name for p in expected_path.glob('merged.ontarget.processed*.tsv'))
+    assert names == sorted(p.name for p in output_path.glob('merged.ontarget.processed*.tsv'))
+    for name in names:
+        assert filecmp.cmp(output_path / name, expected_path / name, shallow=False), name
+
+
+def test_chunked_process_matches_single_pass(single_pass, tmp_path):
+    input_path, expected_path = single_pass
+
+    assert_same_outputs(run_process(input_path, tmp_path / 'chunked', '--chunksize', '64'), expected_path)
+
+
+@pytest.mark.parametrize('options', [['--workers', '3'], ['--workers', '3', '--chunksize', '64']])
+def test_sharded_process_matches_single_pass(single_pass, tmp_path, options):
+    input_path, expected_path = single_pass
+
+    assert_same_outputs(run_process(input_path, tmp_path / 'sharded', *options), expected_path)
@@ -0,0 +1,31 @@
+import argparse
+from os.path import join
+import shutil
+import sys
+
+import pandas as pd
+
+import benchmark
+import strat_pipeline
+import strat_prepare
+
+
+CONFIG = join(strat_pipeline.SCRIPT_DIR, 'config.yaml')
+
+
+def test_fused_summary_matches_separate_stages(tmp_path):
+    separate_dir = tmp_path / 'separate' / 'sample1'
+    fused_dir = tmp_path / 'fused' / 'sample1'
+    benchmark.generate_sample(CONFIG, str(separate_dir), 300, benchmark.EXPANSIONS, 0.02, 0.03, 0.1, 0)
+    shutil.copytree(separate_dir, fused_dir)
+    config = strat_prepare.load_config(CONFIG)
+    args = argparse.Namespace(config=CONFIG, threshold=1, fit_mode='pad', save_merged=False, metrics=False, profile=False)
+
+    strat_pipeline.process(str(separate_dir), 'sample1', config, args, sys.stdout)
+    strat_pipeline.summarize(str(separate_dir), 'sample1', config, args, sys.stdout)
+    strat_pipeline.analyze(str(fused_dir), 'sample1', config, args, sys.stdout)
+
+    for name in ['merged_output.csv', 'merged_output_percents.csv']:
+        df_separate = pd.read_csv(separate_dir / name)
+        assert df_separate['Sample'].tolist() == ['sample1']
+        pd.testing.assert_frame_equal(pd.read_csv(fused_dir / name), df_separate)
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import summarize
+
+
+def processed_table(rng, reads):
+    lens = [3 * rng.choice([rng.randint(5, 49), rng.randint(50, 900)]) for _ in range(reads)]
+    return pd.DataFrame({'direction': [rng.choice(['fwd', 'rev']) for _ in lens], 'len_ins_ext_aln': lens})
+
+
+def summary_by_subsets(df, limit_nt):
+    # Reference - counts and percentiles from one boolean subset at a time
+    alleles = {'Wt': df['len_ins_ext_aln'] < limit_nt, 'Exp': df['len_ins_ext_aln'] >= limit_nt}
+    directions = {'fwd': df['direction'] == 'fwd', 'rev': df['direction'] == 'rev'}
+    row = {
+        'Total on-target reads': len(df),
+        'Fwd reads': int(directions['fwd'].sum()),
+        'Rev reads': int(directions['rev'].sum()),
+        **{f'{allele} reads': int(cond.sum()) for allele, cond in alleles.items()},
+        **{f'{allele}_{direction}': int((cond & cond_direction).sum()) for allele, cond in alleles.items() for direction, cond_direction in directions.items()},
+    }
+    for allele, cond in alleles.items():
+        for perc in summarize.PERCENTILES:
+            row[f'{allele}_{perc}th'] = float(np.percentile(df[cond]['len_ins_ext_aln'], perc)) / 3 if cond.any() else np.nan
+    return row
+
+
+@pytest.mark.parametrize('seed, limit_nt', [(0, 150), (1, 150), (2, 600)])
+def test_summary_matches_subsets(seed, limit_nt):
+    df = processed_table(random.Random(seed), 500)
+
+    master_df, _ = summarize.summary_tables(df, 10, 990, 'sample1', limit_nt)
+
+    row = master_df.iloc[0].to_dict()
+    assert row['Sample'] == 'sample1' and row['Total_reads'] == 1000
+    for key, value in summary_by_subsets(df, limit_nt).items():
+        assert row[key] == pytest.approx(value, nan_ok=True), key
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_cohort_matches_sample_summaries(tmp_path, workers):
+    rng = random.Random(3)
+    paths = []
+    for name in ['s2', 's10', 's1']:
+        (tmp_path / name).mkdir()
+        path = tmp_path / name / 'merged.ontarget.processed.tsv'
+        processed_table(rng, 200).to_csv(path, sep='\t', index=False)
+        paths.append(str(path))
+    # Samples without a lambda alignment summary have no lambda counts
+    (tmp_path / 's2' / 'lambda_alignment').mkdir()
+    (tmp_path / 's2' / 'lambda_alignment' / 'lambda_alignment_summary.tsv').write_text('Aligned\t5\nUnaligned\t300\n')
+
+    cohort = summarize.summarize_cohort(paths, tmp_path / 'cohort_output.csv', workers=workers)
+
+    assert cohort['Sample'].tolist() == ['s2', 's10', 's1']
+    assert cohort['Lambda_reads'].tolist() == [5, 0, 0]
+    expected = pd.concat([summarize.summarize_sample(path) for path in paths], ignore_index=True)
+    pd.testing.assert_frame_equal(cohort, expected)
+    pd.testing.assert_frame_equal(pd.read_csv(tmp_path / 'cohort_output.csv'), expected, check_dtype=False)